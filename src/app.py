@@ -16,16 +16,10 @@ except ImportError:
     print("The WSQ image format is not supported. An import error occurred.")
     print("This may happen on Windows machines.")
 
-from normalize import normalizeMeanVariance
-from ridge_orientation import ridgeOrient
-from region_of_interest import getRoi
-from ridge_frequency import ridgeFreq
-from filters import gaborFilter, butterworth
-from thinning import zhangSuen
-from singularities import poincare, singularityCleanup
-from minutiae import extractMinutiae
-from fp_classes import getClass
 from lib import vals2Grayscale, overlay
+from pipeline import defaultPipeline
+from fields import valuesAt
+from instrumentation import tracing
 
 from PyQt5.QtWidgets import QMainWindow, QFileDialog, QAction, QApplication, QMessageBox, QInputDialog, QLabel
 from PyQt5.QtGui import QPixmap, QImage
@@ -43,6 +37,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.statusbarLabel = QLabel("No image loaded")
         self.statusbarLabel.setMinimumSize(1,1)
         self.statusbar.addWidget(self.statusbarLabel)
+        self.traceLabel = QLabel("")    # the times of the last computed analysis functions
+        self.statusbar.addPermanentWidget(self.traceLabel)
 
         self.params = ParamWindow(self)
         self.params.show()
@@ -55,6 +51,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.blendSigmaForSingularities = 14
 
+        self.pipeline = defaultPipeline()   # Memoized analysis stages of the loaded image
+
         self.img = None             # Will hold the image data
         self.imgArray = None        # Will hold the raw image data in a numpy array
         self.imgShape = None        # Will hold the shape of the loaded image
@@ -63,10 +61,10 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.filtim = None          # Cache for the filtered image
         self.thinned = None         # Cache for the thinned image
-        self.cores = None           # Cache for the core singularity image
-        self.deltas = None          # Cache for the delta singularity image
-        self.bifurcations = None    # Cache for the bifurcation minutiae
-        self.ridgeEndings = None    # Cache for the ridge ending minutiae
+        self.cores = None           # Cache for the core singularity point set
+        self.deltas = None          # Cache for the delta singularity point set
+        self.bifurcations = None    # Cache for the bifurcation minutiae point set
+        self.ridgeEndings = None    # Cache for the ridge ending minutiae point set
 
     def open(self):
         """Open and show an image"""
@@ -90,6 +88,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.currentImage = self.imgArray.copy()    # Currently shown image as numpy array
 
             self.imgShape = self.imgArray.shape
+            self.pipeline.setImage(self.imgArray)
             self.showImage(self.imgArray, normalize=False)
 
             self.scaleFactor = 1.0
@@ -163,42 +162,47 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             return
         self.showBifurcations()
 
-        norm = normalizeMeanVariance(self.imgArray)
-        butter = butterworth(norm)
-        orientim = ridgeOrient(butter, blendSigma=self.params.orientBlend)
+        orientim = self.stage("orientation")
 
         with open("minutiae.json", "w") as f:
-            bifIdx = np.nonzero(self.bifurcations)
-            endIdx = np.nonzero(self.ridgeEndings)
-
-            orientim = (orientim * 180/np.pi).astype(np.int)    # radians to degrees
-            orientim = np.where(orientim == 180, 0, orientim)   # 180 degrees = 0 degrees
-
-            bifOrient = orientim[bifIdx]
-            endOrient = orientim[endIdx]
-
             typedict = {
                 "bifurcations" : [],
                 "ridgeEndings" : []
             }
 
             # save the minutiae x and y positions and their angle (not direction!) to a dictionary
-            x,y,angle = 0,1,2
-            for bifs,ends in zip(zip(bifIdx[1], bifIdx[0], bifOrient), zip(endIdx[1], endIdx[0], endOrient)):
-                typedict["bifurcations"].append({
-                    "X" : int(bifs[x]),
-                    "Y" : int(bifs[y]),
-                    "angle" : int(bifs[angle])
-                })
-                typedict["ridgeEndings"].append({
-                    "X" : int(ends[x]),
-                    "Y" : int(ends[y]),
-                    "angle" : int(ends[angle])
-                })
+            for key, minutiae in (("bifurcations", self.bifurcations), ("ridgeEndings", self.ridgeEndings)):
+                angles = (valuesAt(orientim, minutiae["y"], minutiae["x"]) * 180/np.pi).astype(np.int)  # radians to degrees
+                angles = np.where(angles == 180, 0, angles)                                           # 180 degrees = 0 degrees
+                for x, y, angle in zip(minutiae["x"], minutiae["y"], angles):
+                    typedict[key].append({
+                        "X" : int(x),
+                        "Y" : int(y),
+                        "angle" : int(angle)
+                    })
 
             # dump the dictionary as a json
             json.dump(typedict, f)
 
+    def stage(self, name):
+        """Return the result of the analysis stage `name` of the pipeline for the loaded image
+        with the current parameters. The slowest analysis functions are shown in the status bar."""
+        # only the times are traced, tracing the memory would slow down the analysis
+        with tracing(memory=False) as trace:
+            result = self.pipeline.get(name,
+                                       orientBlend=self.params.orientBlend,
+                                       freqBlend=self.params.freqBlend,
+                                       freqBlock=self.params.freqBlock,
+                                       roiThresh=self.params.roiThresh,
+                                       gaborSize=self.params.gaborSize,
+                                       singularityBlend=self.blendSigmaForSingularities)
+
+        if trace.records:
+            self.traceLabel.setText(trace.summary())
+            self.traceLabel.setToolTip("\n".join(record.name + ": {:.3f} s wall, {:.3f} s CPU".format(record.wall, record.cpu)
+                                                 for record in trace.records if record.depth == 0))
+        return result
+
     def showImage(self, img, normalize=True):
         """Shows an image in the main window."""
         if normalize:
@@ -309,7 +313,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             return
 
         try:
-            norm = normalizeMeanVariance(self.imgArray)
+            norm = self.stage("normalized")
             self.showImage(norm)
         except AttributeError:
             print("An exception occurred! No loaded image found!")
@@ -320,8 +324,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
 
-        norm = normalizeMeanVariance(self.imgArray)
-        orientim = ridgeOrient(norm, blendSigma=self.params.orientBlend, flip=True)
+        orientim = self.stage("flippedOrientation")
 
         orientim = np.rot90(np.rot90(orientim)) # rotate the orientation image by 180 degrees, because quiver shows it upside down
 
@@ -347,8 +350,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
         
-        norm = normalizeMeanVariance(self.imgArray)
-        orientim = ridgeOrient(norm, blendSigma=self.params.orientBlend)
+        orientim = self.stage("normOrientation")
         self.showImage(orientim)
 
     def showRoi(self):
@@ -356,8 +358,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if isinstance(self.imgArray, type(None)):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
-        norm = normalizeMeanVariance(self.imgArray)
-        roi = getRoi(norm, threshold=self.params.roiThresh)
+        norm = self.stage("normalized")
+        roi = self.stage("normRoi")
         self.showImage(norm * roi)
 
     def showFrequency(self):
@@ -365,10 +367,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if isinstance(self.imgArray, type(None)):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
-        norm = normalizeMeanVariance(self.imgArray)
-        orientim = ridgeOrient(norm, blendSigma=self.params.orientBlend)
-        butter = butterworth(norm)
-        freq = ridgeFreq(butter, orientim, blend_sigma=self.params.freqBlend, blocksize=self.params.freqBlock)
+        freq = self.stage("normFrequency")
         self.showImage(freq)
 
     def showButterFilter(self):
@@ -377,8 +376,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
 
-        norm = normalizeMeanVariance(self.imgArray)
-        butter = butterworth(norm)
+        butter = self.stage("butterworth")
 
         self.showImage(butter)
 
@@ -388,12 +386,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
 
-        norm = normalizeMeanVariance(self.imgArray)
-        butter = butterworth(norm)
-        mask = getRoi(butter, threshold=self.params.roiThresh)
-        orientim = ridgeOrient(butter, blendSigma=self.params.orientBlend)
-        freq = ridgeFreq(butter, orientim, blend_sigma=self.params.freqBlend, blocksize=self.params.freqBlock)
-        self.filtim = gaborFilter(butter, orientim, freq, mask, blocksize=self.params.gaborSize)
+        self.filtim = self.stage("gabor")
         self.showImage(self.filtim)
 
     def showThinnedZhangSuen(self):
@@ -402,13 +395,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
 
-        norm = normalizeMeanVariance(self.imgArray)
-        butter = butterworth(norm)
-        mask = getRoi(butter, threshold=self.params.roiThresh)
-        orientim = ridgeOrient(butter, blendSigma=self.params.orientBlend)
-        freq = ridgeFreq(butter, orientim, blend_sigma=self.params.freqBlend, blocksize=self.params.freqBlock)
-        self.filtim = gaborFilter(butter, orientim, freq, mask, blocksize=self.params.gaborSize)
-        self.thinned = zhangSuen((np.invert(self.filtim) * mask).astype(np.float32))
+        self.filtim = self.stage("gabor")
+        self.thinned = self.stage("thinned")
         self.showImage(self.thinned)
 
     def showSingularities(self):
@@ -417,11 +405,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
 
-        norm = normalizeMeanVariance(self.imgArray)
-        mask = getRoi(norm, threshold=self.params.roiThresh)
-        orient = ridgeOrient(norm * mask, blendSigma=self.blendSigmaForSingularities)  # better results with masked image
-        self.cores, self.deltas = poincare(orient) * mask
-        self.cores, self.deltas = singularityCleanup(self.cores, self.deltas, mask)
+        self.cores, self.deltas = self.stage("singularities")
 
         overlaid = overlay(self.imgArray, self.cores, "circle", fill="rgb(0,100,200)", outline="rgb(0,100,200)", offset=self.params.singulSize)
         overlaid = overlay(overlaid, self.deltas, "triangle", fill="rgb(0,255,0)", outline="rgb(0,255,0)", offset=self.params.singulSize)
@@ -433,15 +417,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
         
-        norm = normalizeMeanVariance(self.imgArray)
-        butter = butterworth(norm)
-        mask = getRoi(butter, threshold=self.params.roiThresh)
-        orientim = ridgeOrient(butter, blendSigma=self.params.orientBlend)
-        freq = ridgeFreq(butter, orientim, blend_sigma=self.params.freqBlend, blocksize=self.params.freqBlock)
-        self.filtim = gaborFilter(butter, orientim, freq, mask, blocksize=self.params.gaborSize)
-        self.thinned = zhangSuen((np.invert(self.filtim) * mask).astype(np.float32))
-        self.bifurcations, self.ridgeEndings = extractMinutiae(self.thinned, mask)
-        self.showImage(self.bifurcations)
+        self.filtim = self.stage("gabor")
+        self.thinned = self.stage("thinned")
+        self.bifurcations, self.ridgeEndings = self.stage("minutiae")
 
         overlaid = overlay(self.imgArray, self.bifurcations, "square", outline="rgb(0,255,0)", offset=self.params.minutiaeSize)
         self.showImage(overlaid, normalize=False)
@@ -452,15 +430,9 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.showPopup("No image loaded.", detailedMessage="Load an image through the \"File\" menu.")
             return
 
-        norm = normalizeMeanVariance(self.imgArray)
-        butter = butterworth(norm)
-        mask = getRoi(butter, threshold=self.params.roiThresh)
-        orientim = ridgeOrient(butter, blendSigma=self.params.orientBlend)
-        freq = ridgeFreq(butter, orientim, blend_sigma=self.params.freqBlend, blocksize=self.params.freqBlock)
-        self.filtim = gaborFilter(butter, orientim, freq, mask, blocksize=self.params.gaborSize)
-        self.thinned = zhangSuen((np.invert(self.filtim) * mask).astype(np.float32))
-        self.bifurcations, self.ridgeEndings = extractMinutiae(self.thinned, mask)
-        self.showImage(self.ridgeEndings)
+        self.filtim = self.stage("gabor")
+        self.thinned = self.stage("thinned")
+        self.bifurcations, self.ridgeEndings = self.stage("minutiae")
 
         overlaid = overlay(self.imgArray, self.ridgeEndings, "circle", outline="rgb(255,0,0)", offset=self.params.minutiaeSize)
         self.showImage(overlaid, normalize=False)
@@ -473,7 +445,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
         self.showSingularities()
 
-        fpClass = getClass(self.cores, self.deltas)
+        fpClass = self.stage("fpClass")
         self.showPopup("The fingerprint has the class: " + fpClass)
 
     def createActions(self):
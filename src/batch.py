@@ -0,0 +1,420 @@
+"""Command line batch processing of fingerprint images without the GUI.
+
+Author: Patrik Nemeth
+Xlogin: xnemet04
+School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import OrderedDict
+from contextlib import nullcontext
+
+import numpy as np
+from PIL import Image
+try:
+    import wsq  # registers the WSQ format in PIL
+except ImportError:
+    wsq = None
+
+from lib import vals2Grayscale
+from pipeline import defaultPipeline, DEFAULT_PARAMS, GABOR_THREADS
+from fields import isField, valuesAt
+from parallel import ParallelExecutor
+from streaming import readAhead, writeBehind, STREAM_PREFETCH
+from instrumentation import stage, tracing, currentTrace, formatTrace, writeChromeTrace
+
+# the stages selectable from the command line and the pipeline stages computing them
+STAGES = OrderedDict([
+    ("normalize", "normalized"),
+    ("roi", "roi"),
+    ("orientation", "orientation"),
+    ("frequency", "frequency"),
+    ("gabor", "gabor"),
+    ("thinning", "thinned"),
+    ("singularities", "singularities"),
+    ("minutiae", "minutiae"),
+    ("class", "fpClass"),
+])
+
+# the files searched for in input directories, the same as in the open dialog of the application
+IMAGE_EXTENSIONS = (".png", ".bmp", ".jpg", ".jpeg", ".wsq", ".tif")
+
+_pipeline = None    # the pipeline of the current process, created on first use
+
+def findImages(inputs):
+    """Return the image files in `inputs` - a list of files and directories. The directories are searched
+    for files with one of the `IMAGE_EXTENSIONS` (not recursively) in alphabetical order."""
+    files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path) if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+            files.extend(os.path.join(path, name) for name in names)
+        else:
+            files.append(path)
+
+    return files
+
+@stage
+def loadImage(path):
+    """Load the image file `path` as an 8bit grayscale numpy array."""
+    if os.path.splitext(path)[1].lower() == ".wsq" and wsq is None:
+        raise ValueError("The WSQ image format is not supported. An import error occurred.")
+
+    with Image.open(path) as img:
+        return np.asarray(img.convert("L"))
+
+def pointRecords(points, orientim=None):
+    """Convert a point set into a list of dictionaries with the "X" and "Y" positions of the points.
+    If the orientation image or orientation `BlockField` `orientim` is given, the orientation of the ridges
+    at the points (not direction!) is added as the "angle" in degrees, like in the minutiae export of the application."""
+    records = [{"X" : int(x), "Y" : int(y)} for x, y in zip(points["x"], points["y"])]
+    if orientim is not None:
+        angles = (valuesAt(orientim, points["y"], points["x"]) * 180/np.pi).astype(int)   # radians to degrees
+        angles = np.where(angles == 180, 0, angles)                               # 180 degrees = 0 degrees
+        for record, angle in zip(records, angles):
+            record["angle"] = int(angle)
+
+    return records
+
+def summarize(stage, value, pipeline, params):
+    """Return a JSON serializable summary of the result `value` of the command line stage `stage`."""
+    if stage == "class":
+        return value
+    if stage == "singularities":
+        cores, deltas = value
+        return {"cores" : pointRecords(cores), "deltas" : pointRecords(deltas)}
+    if stage == "minutiae":
+        bifurcations, ridgeEndings = value
+        orientim = pipeline.get("orientation", **params)
+        return {"bifurcations" : pointRecords(bifurcations, orientim), "ridgeEndings" : pointRecords(ridgeEndings, orientim)}
+
+    if stage == "roi":
+        return {"coverage" : float(np.mean(value))}
+
+    if isField(value):
+        value = value.values
+    summary = {"min" : float(np.min(value)), "max" : float(np.max(value)), "mean" : float(np.mean(value))}
+    if stage == "frequency":
+        nonzero = value[value > 0]
+        summary["median"] = float(np.median(nonzero)) if nonzero.size else 0.0
+
+    return summary
+
+def processImage(image, stages, params=None, pipeline=None, gaborThreads=GABOR_THREADS):
+    """Run the command line stages `stages` on a single image.
+
+    Parameters
+    ----------
+    image : numpy_array
+        The input fingerprint image.
+    stages : list
+        Names of the command line stages (keys of `STAGES`).
+    params : dict
+        The values of the pipeline parameters. Defaults to `DEFAULT_PARAMS`.
+    pipeline : Pipeline
+        The pipeline used for the computation. Defaults to a pipeline shared by the calls in one process.
+    gaborThreads : int
+        The number of threads of the Gabor filtering, see `defaultPipeline()`. Defaults to `GABOR_THREADS`.
+
+    Returns
+    -------
+        A dictionary with the JSON serializable summaries of the stages and a dictionary with the arrays
+        of the stages, which produce images."""
+    global _pipeline
+    if pipeline is None:
+        if _pipeline is None:
+            _pipeline = defaultPipeline()
+        pipeline = _pipeline
+    params = dict(DEFAULT_PARAMS if params is None else params)
+
+    pipeline.gaborThreads = gaborThreads
+    pipeline.setImage(image)
+    summaries, arrays = OrderedDict(), OrderedDict()
+    try:
+        for stage in stages:
+            value = pipeline.get(STAGES[stage], **params)
+            summaries[stage] = summarize(stage, value, pipeline, params)
+            if isinstance(value, np.ndarray):
+                arrays[stage] = value
+    finally:
+        # the results of one image are not needed for the next one, keep the memory bounded
+        pipeline.clear()
+
+    return summaries, arrays
+
+def _errorMessage(exc):
+    """Return the description of the exception `exc` put into the records."""
+    return type(exc).__name__ + ": " + str(getattr(exc, "message", exc))
+
+def processFile(path, stages, params=None, trace=False, gaborThreads=GABOR_THREADS):
+    """Load the image file `path` and process it with `processImage()`.
+
+    Parameters
+    ----------
+    path : str
+        The path to the image file.
+    stages : list
+        Names of the command line stages (keys of `STAGES`).
+    params : dict
+        The values of the pipeline parameters. Defaults to `DEFAULT_PARAMS`.
+    trace : bool, str
+        If "time", the times of the analysis functions are recorded into the "trace" of the record
+        (see `instrumentation.Trace.toList()`), if "memory", also their peak memory, which slows them down.
+        Defaults to False.
+    gaborThreads : int
+        The number of threads of the Gabor filtering. Defaults to `GABOR_THREADS`.
+
+    Returns
+    -------
+        A JSON serializable record of the file with the summaries of the stages or the error, which occurred,
+        and a dictionary with the arrays of the image stages."""
+    try:
+        image, error = loadImage(path), None
+    except Exception as exc:
+        image, error = None, exc
+
+    return _processLoaded(path, image, error, stages, params, trace, gaborThreads)
+
+def _processTraced(image, stages, params, trace, gaborThreads):
+    """Process an image with `processImage()` and return its summaries, arrays and trace (None if not traced)."""
+    if not trace:
+        return processImage(image, stages, params, gaborThreads=gaborThreads) + (None,)
+    with tracing(memory=(trace == "memory")) as run:
+        summaries, arrays = processImage(image, stages, params, gaborThreads=gaborThreads)
+    return summaries, arrays, run.toList()
+
+def _processLoaded(path, image, error, stages, params, trace=False, gaborThreads=GABOR_THREADS):
+    """Process a file loaded by `loadImage()`, see `processFile()`. `error` is the exception raised by the loading."""
+    record = OrderedDict([("file", path)])
+    start = time.perf_counter()
+    arrays = {}
+    try:
+        if error is not None:
+            raise error
+        record["shape"] = list(image.shape)
+        record["stages"], arrays, records = _processTraced(image, stages, params, trace, gaborThreads)
+        if trace:
+            record["trace"] = records
+    except Exception as exc:
+        record["error"] = _errorMessage(exc)
+    record["time"] = time.perf_counter() - start
+
+    return record, arrays
+
+def _processShared(image, stages, params, trace, gaborThreads):
+    """Process an image in a worker of the `ParallelExecutor`."""
+    summaries, arrays, records = _processTraced(image, stages, params, trace, gaborThreads)
+    return (list(image.shape), summaries, records), arrays
+
+def _loadedImage(loaded):
+    """Return the image of a (path, image, error) tuple from `readAhead()` or raise its loading error."""
+    if loaded[2] is not None:
+        raise loaded[2]
+    return loaded[1]
+
+def runBatch(files, stages, params=None, executor=None, prefetch=STREAM_PREFETCH, trace=False, gaborThreads=GABOR_THREADS):
+    """Process the image files `files` and yield their results in the order of `files`.
+
+    The files are loaded in a background thread, at most `prefetch` files ahead of the processing, so the decoding
+    of the images overlaps with their processing and the memory stays bounded for any number of files.
+
+    Parameters
+    ----------
+    files : iterable
+        Paths to the image files.
+    stages : list
+        Names of the command line stages (keys of `STAGES`).
+    params : dict
+        The values of the pipeline parameters. Defaults to `DEFAULT_PARAMS`.
+    executor : ParallelExecutor
+        The process pool processing the files. If None, the files are processed in the current process.
+        Defaults to None.
+    prefetch : int
+        The maximum number of loaded files waiting for the processing. Defaults to `STREAM_PREFETCH`.
+    trace : bool, str
+        False, "time" or "memory". Adds the traces of the analysis functions to the records, see `processFile()`.
+        Defaults to False.
+    gaborThreads : int
+        The number of threads of the Gabor filtering of every image. Defaults to `GABOR_THREADS`.
+
+    Yields
+    ------
+        The (record, arrays) tuple of every file."""
+    loaded = readAhead(files, loadImage, prefetch)
+    run = currentTrace()    # the traces of the files are added to the trace of a traced batch
+    try:
+        if executor is None:
+            for path, image, error in loaded:
+                record, arrays = _processLoaded(path, image, error, stages, params, trace, gaborThreads)
+                if run is not None and "trace" in record:
+                    run.extend(record["trace"])
+                yield record, arrays
+            return
+
+        for result in executor.map(_processShared, loaded, _loadedImage, (stages, params, trace, gaborThreads)):
+            record = OrderedDict([("file", result.item[0])])
+            if result.error is None:
+                record["shape"], record["stages"], records = result.value
+                if trace:
+                    record["trace"] = records
+                    if run is not None:
+                        run.extend(records)
+            else:
+                record["error"] = _errorMessage(result.error)
+            record["time"] = result.time
+            yield record, result.arrays
+    finally:
+        loaded.close()
+
+def resultName(path):
+    """Return the name of the results of the image file `path` - its file name with the extension, so the results
+    of e.g. "a.png" and "a.bmp" do not overwrite each other."""
+    return os.path.basename(path)
+
+def nameCollisions(files):
+    """Return the lists of the files in `files`, whose results would have the same `resultName()`."""
+    names = OrderedDict()
+    for path in files:
+        names.setdefault(resultName(path), []).append(path)
+
+    return [paths for paths in names.values() if len(paths) > 1]
+
+@stage
+def writeResult(record, arrays, output, saveImages=False):
+    """Write the record of an image as `<output>/<name>.json` and if `saveImages` is True, also the arrays of the
+    image stages as `<output>/<name>_<stage>.png`, where the name is the `resultName()` of the image file.
+    The paths of the images are added to the record."""
+    name = resultName(record["file"])
+    if saveImages:
+        for stage, value in arrays.items():
+            imagePath = os.path.join(output, name + "_" + stage + ".png")
+            Image.fromarray(vals2Grayscale(value)).save(imagePath)
+            record["stages"][stage]["image"] = imagePath
+
+    with open(os.path.join(output, name + ".json"), "w") as f:
+        json.dump(record, f, indent=2)
+
+def parseArgs(argv=None):
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description="Run the fingerprint analysis stages on images without the GUI.")
+
+    parser.add_argument("inputs", nargs="+", metavar="PATH",
+                        help="Image files or directories with images (" + ", ".join(IMAGE_EXTENSIONS) + ").")
+    parser.add_argument("-s", "--stages", default=",".join(STAGES),
+                        help="Comma separated stages to run, from: " + ", ".join(STAGES) + ". Defaults to all.")
+    parser.add_argument("-o", "--output", default=None, metavar="DIR",
+                        help="Directory for the JSON results of the images. If not given, the results are printed.")
+    parser.add_argument("--images", action="store_true",
+                        help="Also save the images of the image stages as PNG files into the output directory.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes. Defaults to 1 - no workers.")
+    parser.add_argument("--prefetch", type=int, default=STREAM_PREFETCH,
+                        help="Number of images loaded ahead of the processing and of the results waiting to be written. "
+                             "Defaults to " + str(STREAM_PREFETCH) + ".")
+    parser.add_argument("--trace", nargs="?", const="time", default=False, choices=["time", "memory"],
+                        help="Record the times of the analysis functions into the results and print the slowest ones. "
+                             "With \"memory\" also their peak memory, which slows them down.")
+    parser.add_argument("--chrome-trace", default=None, metavar="FILE",
+                        help="Write a trace of the whole run with the loading, the analysis functions in all the processes "
+                             "and the writing into FILE in the Chrome trace event format (chrome://tracing, Perfetto).")
+
+    parser.add_argument("--orient-blend", type=float, default=DEFAULT_PARAMS["orientBlend"],
+                        help="Sigma of the orientation smoothing.")
+    parser.add_argument("--freq-blend", type=float, default=DEFAULT_PARAMS["freqBlend"],
+                        help="Sigma of the frequency smoothing.")
+    parser.add_argument("--freq-block", type=int, default=DEFAULT_PARAMS["freqBlock"],
+                        help="Size of the frequency estimation blocks.")
+    parser.add_argument("--roi-thresh", type=float, default=DEFAULT_PARAMS["roiThresh"],
+                        help="Variance threshold of the region of interest (0 - 1).")
+    parser.add_argument("--roi-mode", default=DEFAULT_PARAMS["roiMode"], choices=["sliding", "block"],
+                        help="Variance computation of the region of interest. \"block\" is faster, but its mask differs "
+                             "on the edge of the fingerprint. Defaults to " + DEFAULT_PARAMS["roiMode"] + ".")
+    parser.add_argument("--gabor-size", type=int, default=DEFAULT_PARAMS["gaborSize"],
+                        help="Size of the Gabor kernels.")
+    parser.add_argument("--gabor-threads", type=int, default=GABOR_THREADS,
+                        help="Number of threads filtering the tiles of an image with the Gabor kernels, for large scans. "
+                             "Defaults to " + str(GABOR_THREADS) + ".")
+    parser.add_argument("--singularity-blend", type=float, default=DEFAULT_PARAMS["singularityBlend"],
+                        help="Sigma of the orientation smoothing for the singularity detection.")
+    parser.add_argument("--dtype", default=DEFAULT_PARAMS["dtype"], choices=["float64", "float32"],
+                        help="Datatype of the floating point images. float32 halves their memory and bandwidth. "
+                             "Defaults to " + DEFAULT_PARAMS["dtype"] + ".")
+
+    args = parser.parse_args(argv)
+
+    args.stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error("The stage \"" + stage + "\" is not recognised.")
+    if args.images and args.output is None:
+        parser.error("Saving images requires an output directory.")
+    if args.jobs < 1:
+        parser.error("The number of jobs must be at least 1.")
+    if args.prefetch < 1:
+        parser.error("The prefetch must be at least 1.")
+    if args.gabor_threads < 1:
+        parser.error("The number of Gabor threads must be at least 1.")
+
+    args.params = {
+        "orientBlend" : args.orient_blend,
+        "freqBlend" : args.freq_blend,
+        "freqBlock" : args.freq_block,
+        "roiThresh" : args.roi_thresh,
+        "roiMode" : args.roi_mode,
+        "gaborSize" : args.gabor_size,
+        "singularityBlend" : args.singularity_blend,
+        "dtype" : args.dtype,
+    }
+
+    return args
+
+def main(argv=None):
+    """Entry point of the command line interface. Returns the exit status - 1 if any of the images failed
+    or if the results of two images would have the same name in the output directory."""
+    args = parseArgs(argv)
+    files = findImages(args.inputs)
+    if args.output is not None:
+        # the results of files with the same name in different directories would overwrite each other
+        collisions = nameCollisions(files)
+        for paths in collisions:
+            print("The results of " + ", ".join(paths) + " would have the same name.", file=sys.stderr)
+        if collisions:
+            return 1
+        os.makedirs(args.output, exist_ok=True)
+
+    executor = ParallelExecutor(args.jobs) if args.jobs > 1 else None
+    failed = []
+
+    def write(result):
+        record, arrays = result
+        if not args.trace:
+            record.pop("trace", None)   # only traced for the Chrome trace
+        if "error" in record:
+            failed.append(record["file"])
+            print(record["file"] + " : " + record["error"], file=sys.stderr)
+        elif args.output is not None:
+            writeResult(record, arrays, args.output, args.images)
+            print(record["file"] + " : {:.2f} s".format(record["time"]) +
+                  (" (" + formatTrace(record["trace"]) + ")" if args.trace else ""))
+        else:
+            print(json.dumps(record))
+
+    # the files are read ahead and the results written behind the processing, all through bounded queues
+    trace = args.trace or ("time" if args.chrome_trace else False)
+    with tracing(memory=False) if args.chrome_trace else nullcontext() as run:
+        writeBehind(runBatch(files, args.stages, args.params, executor, args.prefetch, trace, args.gabor_threads), write, args.prefetch)
+    if args.chrome_trace:
+        writeChromeTrace(args.chrome_trace, run.toList())
+
+    print("Processed " + str(len(files)) + " files, " + str(len(failed)) + " failed.", file=sys.stderr)
+    if executor is not None:
+        throughput = executor.throughput()
+        for worker, (count, busy) in sorted(executor.workers.items()):
+            print("Worker {} : {} files, {:.2f} files/s".format(worker, count, throughput[worker]), file=sys.stderr)
+        print("Total : {:.2f} files/s".format(throughput[None]), file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""Benchmarks of the analysis stages on synthetic fingerprints.
+
+Author: Patrik Nemeth
+Xlogin: xnemet04
+School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+import scipy
+
+from normalize import normalizeMeanVariance
+from region_of_interest import getRoi
+from ridge_orientation import ridgeOrient
+from ridge_frequency import ridgeFreq
+from filters import gaborFilter, butterworth
+from binarization import bradleyThreshold
+from thinning import zhangSuen
+from singularities import poincare, singularityCleanup
+from minutiae import extractMinutiae
+from points import inMask
+
+SIZES = [(300, 260), (500, 440), (800, 700)]    # resolutions (rows, columns) of the synthetic fingerprints
+REPEAT = 3                                      # number of timed runs of every stage, the fastest one is reported
+REGRESSION = 1.2                                # time ratio to the previous results considered a regression
+
+def syntheticFingerprint(rows, cols, seed=0, period=9):
+    """Generate a synthetic fingerprint - ridges of the period `period` pixels curving around a core, with noise,
+    in an elliptic region on a light background.
+
+    Returns
+    -------
+        An 8bit grayscale image of shape (`rows`, `cols`)."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:rows, 0:cols].astype(np.float64)
+    cy, cx = rows * 0.45, cols * 0.5
+
+    # concentric ridges distorted by the angle around the core, so the orientations change in every direction
+    theta = np.arctan2(y - cy, x - cx)
+    phase = 2 * np.pi * np.hypot(y - cy, x - cx) / period + 3 * np.sin(theta)
+    im = 128 + 80 * np.cos(phase) + rng.normal(0, 10, size=(rows, cols))
+
+    ellipse = ((y - cy) / (rows * 0.42))**2 + ((x - cx) / (cols * 0.4))**2 < 1
+    im = np.where(ellipse, im, 200 + rng.normal(0, 2, size=(rows, cols)))
+
+    return np.clip(im, 0, 255).astype(np.uint8)
+
+def _singularities(orient, mask):
+    """Find the singularities the same way as the application."""
+    cores, deltas = poincare(orient, asPoints=True)
+    return inMask(cores, mask), inMask(deltas, mask)
+
+def stageInputs(image, dtype="float64"):
+    """Compute the inputs of all the benchmarked stages from the fingerprint `image`. The floating point images
+    are computed in `dtype`, which is also passed to the stages under "dtype"."""
+    inputs = {"image" : image, "dtype" : dtype}
+    inputs["norm"] = normalizeMeanVariance(image)
+    inputs["butter"] = butterworth(inputs["norm"], dtype=dtype)
+    inputs["mask"] = getRoi(inputs["butter"])
+    inputs["orient"] = ridgeOrient(inputs["butter"], dtype=dtype)
+    inputs["freq"] = ridgeFreq(inputs["butter"], inputs["orient"], dtype=dtype)
+    inputs["gabor"] = gaborFilter(inputs["butter"], inputs["orient"], inputs["freq"], inputs["mask"], dtype=dtype)
+    inputs["thinned"] = zhangSuen((np.invert(inputs["gabor"]) * inputs["mask"]).astype(np.float32))
+    inputs["singularityOrient"] = ridgeOrient(inputs["norm"] * inputs["mask"], blendSigma=14, dtype=dtype)
+    inputs["singularities"] = _singularities(inputs["singularityOrient"], inputs["mask"])
+
+    return inputs
+
+# the benchmarked stages, called with the inputs from `stageInputs()`
+STAGES = OrderedDict([
+    ("normalizeMeanVariance", lambda i: normalizeMeanVariance(i["image"])),
+    ("butterworth", lambda i: butterworth(i["norm"], dtype=i["dtype"])),
+    ("getRoi", lambda i: getRoi(i["butter"])),
+    ("ridgeOrient", lambda i: ridgeOrient(i["butter"], dtype=i["dtype"])),
+    ("ridgeFreq", lambda i: ridgeFreq(i["butter"], i["orient"], dtype=i["dtype"])),
+    ("gaborFilter", lambda i: gaborFilter(i["butter"], i["orient"], i["freq"], i["mask"], dtype=i["dtype"])),
+    ("bradleyThreshold", lambda i: bradleyThreshold(i["butter"], i["mask"])),
+    ("zhangSuen", lambda i: zhangSuen((np.invert(i["gabor"]) * i["mask"]).astype(np.float32))),
+    ("poincare", lambda i: _singularities(i["singularityOrient"], i["mask"])),
+    ("singularityCleanup", lambda i: singularityCleanup(*i["singularities"], i["mask"])),
+    ("extractMinutiae", lambda i: extractMinutiae(i["thinned"], i["mask"], asPoints=True)),
+])
+
+def measure(function, repeat=REPEAT):
+    """Time `function` and measure the peak of the memory it allocates.
+
+    The times are measured without tracing the memory, which slows the code down, and the peak memory
+    is measured in one more run with `tracemalloc`.
+
+    Returns
+    -------
+        The wall times of the `repeat` runs in seconds and the peak memory in bytes."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return times, peak
+
+def _commit():
+    """Return the hash of the checked out commit, or None outside of a git repository."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def runBenchmarks(sizes=SIZES, stages=None, repeat=REPEAT, seed=0, dtype="float64"):
+    """Run the benchmarks of `stages` on synthetic fingerprints of all the `sizes`.
+
+    Parameters
+    ----------
+    sizes : list
+        The (rows, columns) of the fingerprints. Defaults to `SIZES`.
+    stages : list
+        The names of the stages (keys of `STAGES`). Defaults to all.
+    repeat : int
+        The number of timed runs of every stage. Defaults to `REPEAT`.
+    seed : int
+        The seed of the noise of the fingerprints. Defaults to 0.
+    dtype : str
+        The datatype of the floating point images, "float64" or "float32". Defaults to "float64".
+
+    Returns
+    -------
+        A JSON serializable dictionary with the description of the environment under "meta" and the list of
+        the results under "results". A result holds the "stage", the "size" as "<rows>x<columns>", the fastest
+        wall "time" and all the "times" in seconds and the "peak" memory allocated by the stage in bytes."""
+    stages = list(STAGES) if stages is None else stages
+    results = []
+    for rows, cols in sizes:
+        inputs = stageInputs(syntheticFingerprint(rows, cols, seed), dtype)
+        for stage in stages:
+            times, peak = measure(lambda: STAGES[stage](inputs), repeat)
+            results.append(OrderedDict([("stage", stage), ("size", str(rows) + "x" + str(cols)),
+                                        ("time", min(times)), ("times", times), ("peak", peak)]))
+
+    meta = OrderedDict([
+        ("commit", _commit()),
+        ("date", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("python", platform.python_version()),
+        ("numpy", np.__version__),
+        ("scipy", scipy.__version__),
+        ("machine", platform.machine()),
+        ("processor", platform.processor()),
+        ("repeat", repeat),
+        ("seed", seed),
+        ("dtype", dtype),
+    ])
+
+    return OrderedDict([("meta", meta), ("results", results)])
+
+def compare(current, previous, threshold=REGRESSION):
+    """Compare the results of two benchmark runs.
+
+    Parameters
+    ----------
+    current, previous : dict
+        The results of `runBenchmarks()`.
+    threshold : float
+        The ratio of the times, above which a stage is a regression. Defaults to `REGRESSION`.
+
+    Returns
+    -------
+        A list of (stage, size, time ratio, peak memory ratio, regression) tuples of the stages present in both
+        runs. A ratio is None if the previous value is zero."""
+    before = {(result["stage"], result["size"]) : result for result in previous["results"]}
+    rows = []
+    for result in current["results"]:
+        old = before.get((result["stage"], result["size"]))
+        if old is None:
+            continue
+        timeRatio = result["time"] / old["time"] if old["time"] > 0 else None
+        peakRatio = result["peak"] / old["peak"] if old["peak"] > 0 else None
+        rows.append((result["stage"], result["size"], timeRatio, peakRatio, timeRatio is not None and timeRatio > threshold))
+
+    return rows
+
+def _parseSize(text):
+    """Parse a "<rows>x<columns>" size."""
+    try:
+        rows, cols = (int(value) for value in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("The size \"" + text + "\" is not in the <rows>x<columns> format.")
+    return rows, cols
+
+def main(argv=None):
+    """Entry point of the benchmarks. Returns the exit status - 1 if a regression was found."""
+    parser = argparse.ArgumentParser(description="Benchmark the analysis stages on synthetic fingerprints.")
+    parser.add_argument("-s", "--sizes", type=_parseSize, nargs="+", default=SIZES, metavar="ROWSxCOLS",
+                        help="Resolutions of the fingerprints. Defaults to " + " ".join("%dx%d" % size for size in SIZES) + ".")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=None, metavar="STAGE",
+                        help="Stages to benchmark, from: " + ", ".join(STAGES) + ". Defaults to all.")
+    parser.add_argument("-r", "--repeat", type=int, default=REPEAT, help="Number of timed runs. Defaults to " + str(REPEAT) + ".")
+    parser.add_argument("-o", "--output", default=None, metavar="FILE", help="Write the JSON results into FILE.")
+    parser.add_argument("--dtype", default="float64", choices=["float64", "float32"],
+                        help="Datatype of the floating point images. Defaults to float64.")
+    parser.add_argument("-c", "--compare", default=None, metavar="FILE", help="Compare with the JSON results in FILE.")
+    parser.add_argument("-t", "--threshold", type=float, default=REGRESSION,
+                        help="Time ratio considered a regression. Defaults to " + str(REGRESSION) + ".")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("The number of runs must be at least 1.")
+
+    results = runBenchmarks(args.sizes, args.stages, args.repeat, dtype=args.dtype)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        for result in results["results"]:
+            print("{:<22} {:>10} {:10.4f} s {:10.1f} MiB".format(result["stage"], result["size"], result["time"],
+                                                                 result["peak"] / 2**20))
+
+    if args.compare is None:
+        return 0
+
+    with open(args.compare) as f:
+        previous = json.load(f)
+    regressions = 0
+    print("Compared with " + args.compare + " (" + str(previous["meta"].get("commit")) + "):", file=sys.stderr)
+    for stage, size, timeRatio, peakRatio, regression in compare(results, previous, args.threshold):
+        regressions += regression
+        print("{:<22} {:>10}   time x{}   peak x{}{}".format(
+            stage, size, "-" if timeRatio is None else "{:.2f}".format(timeRatio),
+            "-" if peakRatio is None else "{:.2f}".format(peakRatio), "   REGRESSION" if regression else ""), file=sys.stderr)
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,10 @@ School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
 """
 import numpy as np
 
-def bradleyThreshold(img, mask):
+from instrumentation import stage
+
+@stage
+def bradleyThreshold(img, mask, windowFraction=1/12, t=15):
     """Binarizes the input image adaptively.
     Based on:
     Bradley, D. a Roth, G. Adaptive thresholding using the integral image. Journal of
@@ -18,46 +21,49 @@ def bradleyThreshold(img, mask):
         The input image to be binarized.
     mask : numpy_array
         The binary region of interest mask of the fingerprint `img`.
+    windowFraction : float
+        The size of the averaging window as a fraction of the image width. Bradley recommends an eighth
+        of the image width, but a twelfth seems to yield better results. Defaults to 1/12.
+    t : int, float
+        A pixel is set to True if its value is more than `t` percent above the window average. Defaults to 15.
         
     Returns
     -------
-        A binarized version of `img`."""
+        A binarized version of `img`. Pixels outside of `mask` and pixels, whose window reaches
+        over the image border, are False."""
 
     rows, cols = img.shape
 
-    #integral image - the numpy way
-    intImg = np.zeros_like(img).astype(np.int32)
-    intImg = np.cumsum(np.cumsum(img, axis=0), axis=1)
+    #integral image - the numpy way, in float64 even for float32 images, whose sums would lose precision
+    intImg = np.cumsum(np.cumsum(img, axis=0, dtype=np.float64), axis=1)
 
     out = np.zeros_like(img).astype(np.bool)
-    s = int(cols / 12) # Bradley recommends an eighth of the image width, but a twelfth seems to yield better results
-    t = 15
-    for i in range(cols):
-        for j in range(rows):
-            # check for ROI
-            if not mask[j,i]:
-                continue
-
-            x1 = int(j - s/2)
-            x2 = int(j + s/2)
-            y1 = int(i - s/2)
-            y2 = int(i + s/2)
-
-            # border check - don't know how else to handle it
-            if x1 - 1 < 0 or x2 >= rows:
-                out[j,i] = False
-                continue
-            if y1 - 1 < 0 or y2 >= cols:
-                out[j,i] = False
-                continue
-
-            count = (x2 - x1) * (y2 - y1)
-
-            sm = intImg[x2, y2] - intImg[x2, y1 - 1] - intImg[x1 - 1, y2] + intImg[x1 - 1, y1 - 1]
-
-            if (img [j,i] * count) <= (sm * (100 - t) / 100):
-                out[j,i] = False
-            else:
-                out[j,i] = True
-    
-    return out
\ No newline at end of file
+    s = int(cols * windowFraction)
+
+    # window borders for every row and column - the same for the whole row or column, so there is no need
+    #   to compute them per pixel (flooring is the same as truncation for all the non-border windows)
+    x1 = np.floor(np.arange(rows) - s/2).astype(np.int64)
+    x2 = np.floor(np.arange(rows) + s/2).astype(np.int64)
+    y1 = np.floor(np.arange(cols) - s/2).astype(np.int64)
+    y2 = np.floor(np.arange(cols) + s/2).astype(np.int64)
+
+    # border check - windows reaching out of the image stay False
+    validRows = np.flatnonzero((x1 - 1 >= 0) & (x2 < rows))
+    validCols = np.flatnonzero((y1 - 1 >= 0) & (y2 < cols))
+    if validRows.size == 0 or validCols.size == 0:
+        return out
+
+    x1, x2 = x1[validRows].reshape((-1, 1)), x2[validRows].reshape((-1, 1))
+    y1, y2 = y1[validCols], y2[validCols]
+
+    count = (x2 - x1) * (y2 - y1)
+
+    sm = intImg[x2, y2] - intImg[x2, y1 - 1] - intImg[x1 - 1, y2] + intImg[x1 - 1, y1 - 1]
+
+    inner = np.ix_(validRows, validCols)
+    out[inner] = (img[inner] * count) > (sm * (100 - t) / 100)
+
+    # check for ROI
+    out[mask == False] = False
+
+    return out
@@ -19,4 +19,8 @@ class InvalidDataType(ImageProcessingError):
 
 class InvalidInputImageDimensions(ImageProcessingError):
     """Exception raised when the input image array is not a 2D array."""
-    pass
\ No newline at end of file
+    pass
+
+class InvalidParameterValue(ImageProcessingError):
+    """Exception raised when a parameter has a value, which is not one of the recognised options."""
+    pass
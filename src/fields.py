@@ -0,0 +1,166 @@
+"""Block-resolution orientation and frequency fields.
+
+Author: Patrik Nemeth
+Xlogin: xnemet04
+School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
+"""
+import numpy as np
+
+class BlockField:
+    """A quantity estimated in square blocks of an image (e.g. ridge orientations or frequencies), stored as one value
+    per block together with the geometry of the blocks. Block (i, j) covers the pixels
+    [`origin` + i * `blocksize`, `origin` + (i+1) * `blocksize`) in both axes and its value belongs to its center.
+
+    Angular fields hold orientations from 0 to Pi, which are interpolated through their doubled angles, so the
+    orientations around 0 and Pi do not cancel out. The interpolated orientations follow the convention of
+    `ridgeOrient()` - they are in the interval (0, Pi]."""
+    def __init__(self, values, blocksize, shape, origin=0, fill=None, angular=False):
+        """Parameters
+        ----------
+        values : numpy_array
+            A 2D array with the value of every block.
+        blocksize : int
+            The size of the blocks in pixels.
+        shape : tuple
+            The shape of the image the field belongs to.
+        origin : int
+            The first pixel of the first block in both axes. Defaults to 0.
+        fill : int, float
+            The value of the pixels, which are not covered by any block, both with and without interpolation.
+            If None, the pixels take the value of the nearest block. Defaults to None.
+        angular : bool
+            True if the values are orientations in radians. Defaults to False."""
+        self.values = np.asarray(values)
+        self.blocksize = blocksize
+        self.shape = tuple(shape)
+        self.origin = origin
+        self.fill = fill
+        self.angular = angular
+
+        if angular:
+            self._cos = np.cos(2 * self.values)
+            self._sin = np.sin(2 * self.values)
+
+    def _blockIndices(self, coords, axis):
+        """Return the block indices of pixel coordinates `coords` along `axis` and a mask of the covered pixels."""
+        idx = np.floor_divide(np.asarray(coords) - self.origin, self.blocksize)
+        covered = (idx >= 0) & (idx < self.values.shape[axis])
+        return np.clip(idx, 0, self.values.shape[axis] - 1), covered
+
+    def _empty(self, r, c):
+        """Return the values of pixels (`r`, `c`) of a field without any blocks."""
+        return np.full(np.broadcast(r, c).shape, 0 if self.fill is None else self.fill, dtype=np.float64)
+
+    def at(self, r, c):
+        """Return the value of the block containing pixel (`r`, `c`). Works with arrays of coordinates as well.
+        Pixels outside of all the blocks get the `fill` value."""
+        if self.values.size == 0:
+            return self._empty(r, c)
+
+        rowIdx, rowCovered = self._blockIndices(r, 0)
+        colIdx, colCovered = self._blockIndices(c, 1)
+        values = self.values[rowIdx, colIdx]
+        if self.fill is not None:
+            values = np.where(rowCovered & colCovered, values, self.fill)
+
+        return values
+
+    def _interpolation(self, coords, axis):
+        """Return the indices of the two block centers surrounding the pixel coordinates `coords` along `axis`
+        and the weight of the second one. Coordinates beyond the first or last center are clamped."""
+        last = self.values.shape[axis] - 1
+        position = (np.asarray(coords, dtype=np.float64) - self.origin - (self.blocksize - 1) / 2) / self.blocksize
+        position = np.clip(position, 0, last)
+        low = np.clip(position.astype(int), 0, max(last - 1, 0))
+        high = np.minimum(low + 1, last)
+
+        return low, high, position - low
+
+    def _combine(self, grids, weighted):
+        """Interpolate every grid in `grids` with the function `weighted` and convert the doubled angles of an
+        angular field back into orientations."""
+        results = [weighted(grid) for grid in grids]
+        if self.angular:
+            return np.pi / 2 + np.arctan2(-results[1], -results[0]) / 2
+        return results[0]
+
+    def sample(self, r, c):
+        """Bilinearly interpolate the field at pixels (`r`[i], `c`[i]) between the centers of the blocks.
+
+        Parameters
+        ----------
+        r, c : numpy_array
+            The row and column coordinates of the pixels. Need not be integers.
+
+        Returns
+        -------
+            An array of the same shape as `r` with the interpolated values. Pixels outside of all the blocks get
+            the `fill` value."""
+        if self.values.size == 0:
+            return self._empty(r, c)
+
+        rowLow, rowHigh, rowWeight = self._interpolation(r, 0)
+        colLow, colHigh, colWeight = self._interpolation(c, 1)
+
+        def weighted(grid):
+            top = grid[rowLow, colLow] * (1 - colWeight) + grid[rowLow, colHigh] * colWeight
+            bottom = grid[rowHigh, colLow] * (1 - colWeight) + grid[rowHigh, colHigh] * colWeight
+            return top * (1 - rowWeight) + bottom * rowWeight
+
+        values = self._combine(self._grids(), weighted)
+        if self.fill is not None:
+            covered = self._blockIndices(np.floor(r), 0)[1] & self._blockIndices(np.floor(c), 1)[1]
+            values = np.where(covered, values, self.fill)
+
+        return values
+
+    def toDense(self, interpolate=False, dtype=np.float64):
+        """Convert the field into an image of the size of the original image.
+
+        Parameters
+        ----------
+        interpolate : bool
+            If False, every pixel takes the value of its block (see `at()`) and the image is blocky. If True,
+            the values are bilinearly interpolated (see `sample()`). Defaults to False.
+        dtype : numpy_dtype
+            The datatype of the image. Defaults to float64.
+
+        Returns
+        -------
+            A 2D array of shape `shape`."""
+        rows, cols = self.shape
+        if not interpolate or self.values.size == 0:
+            return self.at(np.arange(rows).reshape((-1, 1)), np.arange(cols).reshape((1, -1))).astype(dtype)
+
+        # separable interpolation - along the rows and then along the columns
+        rowLow, rowHigh, rowWeight = self._interpolation(np.arange(rows), 0)
+        colLow, colHigh, colWeight = self._interpolation(np.arange(cols), 1)
+        rowWeight, colWeight = rowWeight.reshape((-1, 1)), colWeight.reshape((1, -1))
+
+        def weighted(grid):
+            grid = grid[rowLow] * (1 - rowWeight) + grid[rowHigh] * rowWeight
+            return grid[:, colLow] * (1 - colWeight) + grid[:, colHigh] * colWeight
+
+        dense = self._combine(self._grids(), weighted)
+        if self.fill is not None:
+            covered = self._blockIndices(np.arange(rows), 0)[1].reshape((-1, 1)) & self._blockIndices(np.arange(cols), 1)[1]
+            dense = np.where(covered, dense, self.fill)
+
+        return dense.astype(dtype)
+
+    def _grids(self):
+        """Return the grids, which are interpolated - the doubled angle components for angular fields."""
+        if self.angular:
+            return (self._cos, self._sin)
+        return (self.values,)
+
+def valuesAt(img, r, c):
+    """Return the values of the image or `BlockField` `img` at pixels (`r`[i], `c`[i]). A field is interpolated
+    at the pixels (see `BlockField.sample()`)."""
+    if isField(img):
+        return img.sample(r, c)
+    return img[r, c]
+
+def isField(obj):
+    """Return True if `obj` is a `BlockField`."""
+    return isinstance(obj, BlockField)
@@ -6,6 +6,10 @@ School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
 """
 import numpy as np
 
+import points as pts
+from instrumentation import stage
+
+@stage
 def getClass(cores, deltas):
     """Returns the class of a fingerprint based on singularity information.
     Based on:
@@ -15,16 +19,18 @@ def getClass(cores, deltas):
     Parameters
     ----------
     cores : numpy_array
-        A binary 2D array with non-zero values specifying the position of the cores in a fingerprint image.
+        A binary 2D array with non-zero values specifying the position of the cores in a fingerprint image,
+        or a point set of the cores.
     deltas : numpy_array
-        A binary 2D array with non-zero values specifying the position of the deltas in a fingerprint image.
+        A binary 2D array with non-zero values specifying the position of the deltas in a fingerprint image,
+        or a point set of the deltas.
         
     Returns
     -------
         A string containing the type of the fingerprint. May return `unknown` if singularities do not match any
         of the rules."""
-    numCores = np.sum(cores)
-    numDeltas = np.sum(deltas)
+    numCores = cores.size if pts.isPoints(cores) else np.sum(cores)
+    numDeltas = deltas.size if pts.isPoints(deltas) else np.sum(deltas)
 
     if numCores == 0 and numDeltas == 0:
         return "arch"
@@ -45,15 +51,17 @@ def specifyLoopType(cores, deltas):
     Parameters
     ----------
     cores : numpy_array
-        A binary 2D array with non-zero values specifying the position of the cores in a fingerprint image.
+        A binary 2D array with non-zero values specifying the position of the cores in a fingerprint image,
+        or a point set of the cores.
     deltas : numpy_array
-        A binary 2D array with non-zero values specifying the position of the deltas in a fingerprint image.
+        A binary 2D array with non-zero values specifying the position of the deltas in a fingerprint image,
+        or a point set of the deltas.
         
     Returns
     -------
         A string containing the type of the loop."""
-    cY, cX = np.where(cores)
-    dY, dX = np.where(deltas)
+    cY, cX = (cores["y"], cores["x"]) if pts.isPoints(cores) else np.where(cores)
+    dY, dX = (deltas["y"], deltas["x"]) if pts.isPoints(deltas) else np.where(deltas)
 
     slope = (dY - cY) / (dX - cX)
 
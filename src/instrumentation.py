@@ -0,0 +1,253 @@
+"""Timing and memory instrumentation of the analysis stages.
+
+Author: Patrik Nemeth
+Xlogin: xnemet04
+School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
+"""
+import os
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+# a finished call of a stage function or a finished span
+StageRecord = namedtuple("StageRecord", ["name", "kind", "wall", "cpu", "peak", "shape", "depth",
+                                         "start", "pid", "thread", "threadName", "args"])
+
+class _Local(threading.local):
+    trace = None    # the trace of the current thread, if the thread is tracing
+    stack = None    # the running stages and spans of the current thread
+    memory = False  # whether the current thread measures the peak memory, only the thread, which started the trace
+
+_local = _Local()
+
+class Trace:
+    """The records of the stage function calls and spans of one run, in the order in which they finished.
+
+    A record holds the `name` of the function or span, its `kind` ("stage" or "span"), the `wall` and `cpu`
+    (of the whole process) time in seconds, the `peak` memory allocated by the call in bytes (None if the memory
+    is not traced), the `shape` of its input image (None for spans), the `depth` of the call - 0 for stages called
+    directly, 1 for the stages and spans they contain and so on, the `start` time (`time.perf_counter()`, which is
+    shared by the processes of a machine), the process and thread IDs `pid` and `thread`, the `threadName` and
+    the `args` of a span.
+
+    `tracemalloc` has a single peak for the whole process, so only the thread, which started the trace, measures
+    the peak memory. The peaks of its stages include the memory allocated by the threads they start, the records
+    of the attached threads (see `attach()`) have no peak."""
+    def __init__(self, memory=True):
+        """Parameters
+        ----------
+        memory : bool
+            If True, the peak memory of the stages is measured with `tracemalloc`, which slows down the allocations.
+            Defaults to True."""
+        self.memory = memory and hasattr(tracemalloc, "reset_peak")     # needs Python 3.9+
+        self.records = []
+
+    def _begin(self, name, kind, shape, args):
+        """Start recording a stage or span in the current thread."""
+        stack = _local.stack
+        frame = [name, kind, shape, args, None, None, time.perf_counter(), time.process_time()]
+        if self.memory and _local.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if stack and stack[-1][4] is not None:
+                stack[-1][5] = max(stack[-1][5], peak)
+            tracemalloc.reset_peak()
+            frame[4], frame[5] = current, current   # memory at the start, highest peak so far
+        stack.append(frame)
+
+    def _end(self):
+        """Finish recording the innermost stage or span of the current thread."""
+        wall, cpu = time.perf_counter(), time.process_time()
+        stack = _local.stack
+        name, kind, shape, args, startMemory, highest, startWall, startCpu = stack.pop()
+        peak = None
+        if startMemory is not None:
+            # the peak of the outer stage covers the peaks of its inner stages, which reset the peak
+            highest = max(highest, tracemalloc.get_traced_memory()[1])
+            peak = highest - startMemory
+            if stack and stack[-1][4] is not None:
+                stack[-1][5] = max(stack[-1][5], highest)
+            tracemalloc.reset_peak()
+
+        thread = threading.current_thread()
+        self.records.append(StageRecord(name, kind, wall - startWall, cpu - startCpu, peak, shape, len(stack),
+                                        startWall, os.getpid(), thread.ident, thread.name, args))
+
+    def _run(self, function, args, kwargs):
+        """Call the stage `function` and record it."""
+        shape = next((tuple(arg.shape) for arg in args if hasattr(arg, "shape")), None)
+        self._begin(function.__name__, "stage", shape, None)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._end()
+
+    def extend(self, records):
+        """Add the records from `toList()` of another trace, e.g. of a worker process."""
+        for record in records:
+            record = dict(record)
+            record["shape"] = None if record["shape"] is None else tuple(record["shape"])
+            self.records.append(StageRecord(**record))
+
+    def toList(self):
+        """Return the records as a JSON serializable list of dictionaries."""
+        records = []
+        for record in self.records:
+            record = OrderedDict(record._asdict())
+            record["shape"] = None if record["shape"] is None else list(record["shape"])
+            records.append(record)
+        return records
+
+    def summary(self, limit=3):
+        """Return a one line summary of the slowest stages, see `formatTrace()`."""
+        return formatTrace(self.toList(), limit)
+
+def formatTrace(records, limit=3):
+    """Return a one line summary of the `limit` stages with the longest total wall time in the trace `records`
+    (a list from `Trace.toList()`). Only the stages called directly are counted."""
+    totals = OrderedDict()
+    for record in records:
+        if record["depth"] != 0 or record["kind"] != "stage":
+            continue
+        wall, peak = totals.get(record["name"], (0.0, None))
+        if record["peak"] is not None:
+            peak = max(peak or 0, record["peak"])
+        totals[record["name"]] = (wall + record["wall"], peak)
+
+    slowest = sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+    parts = []
+    for name, (wall, peak) in slowest:
+        part = name + " {:.3f} s".format(wall)
+        if peak is not None:
+            part += " {:.1f} MiB".format(peak / 2**20)
+        parts.append(part)
+
+    return ", ".join(parts)
+
+def chromeTrace(records):
+    """Convert the trace `records` (a list from `Trace.toList()`) into the Chrome trace event format, which can be
+    loaded into trace viewers (chrome://tracing, Perfetto). Every record becomes a complete event on the timeline
+    of its process and thread, so the nesting of the stages and spans and the idle time of the threads and worker
+    processes are visible.
+
+    Returns
+    -------
+        A JSON serializable dictionary with the events."""
+    origin = min((record["start"] for record in records), default=0)
+    events, threads = [], OrderedDict()
+    for record in sorted(records, key=lambda record: (record["start"], -record["wall"])):
+        args = OrderedDict(record["args"] or {})
+        if record["shape"] is not None:
+            args["shape"] = record["shape"]
+        args["cpu"] = record["cpu"]
+        if record["peak"] is not None:
+            args["peak"] = record["peak"]
+
+        events.append(OrderedDict([("name", record["name"]), ("cat", record["kind"]), ("ph", "X"),
+                                   ("ts", (record["start"] - origin) * 1e6), ("dur", record["wall"] * 1e6),
+                                   ("pid", record["pid"]), ("tid", record["thread"]), ("args", args)]))
+        threads[(record["pid"], record["thread"])] = record["threadName"]
+
+    for (pid, thread), name in threads.items():
+        events.append(OrderedDict([("name", "thread_name"), ("ph", "M"), ("pid", pid), ("tid", thread),
+                                   ("args", {"name" : name})]))
+
+    return OrderedDict([("traceEvents", events), ("displayTimeUnit", "ms")])
+
+def writeChromeTrace(path, records):
+    """Write the trace `records` (a list from `Trace.toList()`) into the file `path` in the Chrome trace event format."""
+    with open(path, "w") as f:
+        json.dump(chromeTrace(records), f)
+
+@contextmanager
+def attach(trace, memory=False):
+    """Record the calls of the stage functions in the current thread into the existing `trace` (may be None).
+    Lets the threads started by a traced run contribute to its trace.
+
+    Parameters
+    ----------
+    trace : Trace
+        The trace of the run or None.
+    memory : bool
+        If True, the current thread measures the peak memory of its stages, if the trace does. Only one thread
+        may do so, because resetting the peak of `tracemalloc` affects all the threads. Defaults to False."""
+    previous = _local.trace, _local.stack, _local.memory
+    _local.trace, _local.stack, _local.memory = trace, [], memory
+    try:
+        yield trace
+    finally:
+        _local.trace, _local.stack, _local.memory = previous
+
+@contextmanager
+def tracing(memory=True):
+    """Record the calls of the stage functions in the current thread into a new `Trace`.
+
+    Parameters
+    ----------
+    memory : bool
+        If True, the peak memory of the stages is measured too. Starts `tracemalloc` for the duration of the run,
+        if it is not running already. Defaults to True.
+
+    Yields
+    ------
+        The `Trace` of the run."""
+    trace = Trace(memory)
+    started = trace.memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        with attach(trace, memory=True):
+            yield trace
+    finally:
+        if started:
+            tracemalloc.stop()
+
+def currentTrace():
+    """Return the trace of the current thread or None, if the thread is not tracing."""
+    return _local.trace
+
+class _Span:
+    """A context manager recording a span into a trace."""
+    def __init__(self, trace, name, args):
+        self.trace, self.name, self.args = trace, name, args
+
+    def __enter__(self):
+        self.trace._begin(self.name, "span", None, self.args)
+        return self
+
+    def __exit__(self, *exc):
+        self.trace._end()
+        return False
+
+class _NoSpan:
+    """A context manager doing nothing, used outside of tracing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(name, **args):
+    """Return a context manager, which records the enclosed sub-step of a stage (e.g. an iteration) into the trace
+    of the current thread under `name` with the arguments `args`. Does nothing outside of `tracing()`."""
+    trace = _local.trace
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, args or None)
+
+def stage(function):
+    """Decorator of the stage functions, which records their calls into the trace of the current thread.
+    Outside of `tracing()` the only overhead is a lookup of the trace."""
+    @functools.wraps(function)
+    def traced(*args, **kwargs):
+        trace = _local.trace
+        if trace is None:
+            return function(*args, **kwargs)
+        return trace._run(function, args, kwargs)
+
+    return traced
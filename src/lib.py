@@ -8,6 +8,12 @@ import numpy as np
 from PIL import Image, ImageDraw
 import os
 
+import exceptions as e
+import points as pts
+
+# the datatypes of the floating point images of the analyses
+FLOAT_TYPES = (np.float32, np.float64)
+
 def vals2Grayscale(vals):
     """Redistribute (normalize) values in parameter `vals` to range of an 8 bit grayscale image.
     This method implicitly converts the `vals` datatype to a float32 for the calculations and
@@ -32,6 +38,64 @@ def vals2Grayscale(vals):
 
     return np.uint8((vals - vMin) * (255 / (vMax - vMin)))
 
+def floatType(dtype):
+    """Return the floating point datatype of the images of an analysis specified by `dtype`.
+
+    Parameters
+    ----------
+    dtype : str, numpy.dtype
+        The specified datatype - float32 or float64 (e.g. "float32", np.float32).
+
+    Returns
+    -------
+        The `dtype` as a numpy.dtype.
+
+    Raises
+    ------
+    InvalidParameterValue
+        If `dtype` is not float32 or float64. None is rejected, although numpy reads it as float64."""
+    if dtype is None:
+        raise e.InvalidParameterValue("The specified datatype is not recognised.")
+    try:
+        dtype = np.dtype(dtype)
+    except TypeError:
+        raise e.InvalidParameterValue("The specified datatype is not recognised.")
+    if dtype not in FLOAT_TYPES:
+        raise e.InvalidParameterValue("The specified datatype is not recognised.")
+
+    return dtype
+
+# offsets of the 8 neighbors of a pixel, clockwise from the top one - P2 to P9 in the Zhang-Suen notation.
+#   The i-th neighbor is encoded as the i-th bit of the neighborhood codes returned by `neighborCodes()`.
+NEIGHBOR_OFFSETS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+
+def neighborCodes(im):
+    """Encode the 3x3 neighborhood of every pixel of the binary image `im` into an 8 bit code.
+    Pixels outside of the image are treated as zeros.
+
+    Parameters
+    ----------
+    im : numpy_array
+        A 2D binary array. Nonzero values are considered as ones.
+
+    Returns
+    -------
+        A uint8 array of the same size as `im`. The i-th bit of each value is set, if the i-th neighbor
+        in `NEIGHBOR_OFFSETS` of the pixel is nonzero."""
+    rows, cols = im.shape
+    padded = np.pad(im != 0, 1).astype(np.uint8)
+
+    codes = np.zeros(im.shape, dtype=np.uint8)
+    for bit, (dr, dc) in enumerate(NEIGHBOR_OFFSETS):
+        codes |= padded[1+dr : 1+dr+rows, 1+dc : 1+dc+cols] << bit
+
+    return codes
+
+def codeBits(code):
+    """Return the neighbors encoded in the 8 bit neighborhood `code` as an array of 8 zeros and ones
+    in the order of `NEIGHBOR_OFFSETS`."""
+    return (code >> np.arange(8)) & 1
+
 def overlay(img, overlayImg, marker, fill=None, outline=None, offset=3):
     """Overlays markers over the input image `img`. The markers' position is determined by the image `overlayImg` -
     where `overlayImg` contains nonzero values, these positions will be used as positions for the markers.
@@ -43,6 +107,7 @@ def overlay(img, overlayImg, marker, fill=None, outline=None, offset=3):
         The base image, onto which the markers will be placed.
     overlayImg : numpy_array
         An overlay image. The markers will be placed on positions where this image is nonzero.
+        May also be a point set, in which case the markers are placed on the positions of the points.
     marker : str
         Specifies the marker type. May be of three values: "square", "circle" or "triangle".
     fill : str
@@ -60,13 +125,16 @@ def overlay(img, overlayImg, marker, fill=None, outline=None, offset=3):
     if not isinstance(marker, str):
         raise TypeError("The marker type must be specified by a string. See docstring for accepted values.")
 
+    if pts.isPoints(overlayImg):
+        rows, cols = overlayImg["y"], overlayImg["x"]
+    else:
+        rows, cols = np.where(np.asarray(overlayImg).astype(np.uint8))
+
     # prevent changing the originals by reference
-    overlayImg = np.copy(overlayImg).astype(np.uint8)
     img = np.copy(img).astype(np.uint8)
 
     img = (img - np.amin(img)) * (255 / (np.amax(img) - np.amin(img))).astype(np.uint8)
 
-    rows,cols = np.where(overlayImg)
     img = Image.fromarray(img)
     img = img.convert("RGB")
     draw = ImageDraw.Draw(img)
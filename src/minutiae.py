@@ -5,9 +5,15 @@ Xlogin: xnemet04
 School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
 """
 import numpy as np
-from singularities import deleteNearMask
 
-def extractMinutiae(thinned, mask):
+import exceptions as e
+from singularities import deleteNearMask, maskDistance, deleteNearMaskDistance
+from lib import neighborCodes, codeBits
+import points as pts
+from instrumentation import stage
+
+@stage
+def extractMinutiae(thinned, mask, asPoints=False, method="sequential"):
     """Returns two arrays of the same size as `thinned`, which contain pixels indicating friction ridge bifurcations and
     ridge endings respectively.
     Based on:
@@ -19,21 +25,38 @@ def extractMinutiae(thinned, mask):
     ----------
     thinned : numpy_array
         A binary array of a thinned fingerprint image.
+    mask : numpy_array
+        A 2D binary array with nonzero values denoting the region of interest.
+    asPoints : bool
+        If True, the minutiae are returned as point sets (see `points.py`) instead of dense arrays. Defaults to False.
+    method : str
+        Either "sequential" or "grid". Specifies how the minutiae near the edge of `mask` are deleted. The "sequential"
+        method uses `deleteNearMask()`, the "grid" method looks the points up in a distance transform of `mask`
+        via `deleteNearMaskDistance()` in constant time per minutia. The "grid" method implies `asPoints`.
+        Defaults to "sequential".
         
     Returns
     -------
         Two binary image arrays of the same size as `thinned`. First contains the bifurcations and the second the ridge endings."""
-    i, j = np.where(thinned == 1) # najdi indexy pixelov, kde su linie
-    minutiae = np.zeros_like(thinned).astype(np.uint8)
+    ridges = thinned == 1 # najdi pixely, kde su linie
+
+    # crossings of every ridge pixel looked up by the code of its neighborhood - pixels outside of the image count as zeros
+    minutiae = np.where(ridges, CROSSING_TABLE[neighborCodes(ridges)], 0).astype(np.uint8)
 
-    for i,j in zip(i,j):
-        try:
-            minutiae[i,j] += calc_minutia(thinned[i-1:i+2, j-1:j+2])
-        except ValueError:
-            minutiae[i,j] = 0
+    if method == "grid":
+        distance = maskDistance(mask)
+        bifurcations = deleteNearMaskDistance(pts.fromDense(minutiae == 6, pts.BIFURCATION), distance)
+        ridgeEndings = deleteNearMaskDistance(pts.fromDense(minutiae == 2, pts.RIDGE_ENDING), distance)
+        return bifurcations, ridgeEndings
+    elif method != "sequential":
+        raise e.InvalidParameterValue("The specified minutiae cleanup method is not recognised.")
 
-    bifurcations = np.where(minutiae == 6, 1, 0)
-    ridgeEndings = np.where(minutiae == 2, 1, 0)
+    if asPoints:
+        bifurcations = pts.fromDense(minutiae == 6, pts.BIFURCATION)
+        ridgeEndings = pts.fromDense(minutiae == 2, pts.RIDGE_ENDING)
+    else:
+        bifurcations = np.where(minutiae == 6, 1, 0)
+        ridgeEndings = np.where(minutiae == 2, 1, 0)
 
     bifurcations = deleteNearMask(bifurcations, mask)
     ridgeEndings = deleteNearMask(ridgeEndings, mask)
@@ -54,4 +77,20 @@ def calc_minutia(s):
     diffs = np.abs(np.diff(unrolled, append=unrolled[0]))   # detect 1-0 and 0-1 pixel neighbors
     final_sum = np.sum(diffs)
 
-    return final_sum
\ No newline at end of file
+    return final_sum
+
+def crossingTable():
+    """Precompute the number of 0->1 and 1->0 crossings around the center pixel for all the 256 possible neighborhoods.
+
+    Returns
+    -------
+        A uint8 array of 256 values indexed by the neighborhood codes from `lib.neighborCodes()`.
+        The values are the same as returned by `calc_minutia()` for the corresponding 3x3 segments."""
+    table = np.zeros(256, dtype=np.uint8)
+    for code in range(256):
+        unrolled = codeBits(code).astype(np.int8)
+        table[code] = np.sum(np.abs(np.diff(unrolled, append=unrolled[0])))
+
+    return table
+
+CROSSING_TABLE = crossingTable()
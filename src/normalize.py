@@ -7,7 +7,9 @@ School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
 import numpy as np
 
 import exceptions as e
+from instrumentation import stage
 
+@stage
 def normalizeMeanVariance(im):
     """Image normalization based on desired image mean and variance (both 100) values.
     Based on:
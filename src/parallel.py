@@ -0,0 +1,167 @@
+"""Parallel processing of images in a process pool with the images and results passed through shared memory.
+
+Author: Patrik Nemeth
+Xlogin: xnemet04
+School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
+"""
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from instrumentation import span
+
+PREFETCH = 2    # number of images per worker decoded and placed in shared memory ahead of the workers
+
+# a shared memory array as passed between the processes
+SharedArray = namedtuple("SharedArray", ["name", "shape", "dtype"])
+
+# the result of one image
+Result = namedtuple("Result", ["item", "value", "arrays", "error", "time", "worker"])
+
+def toShared(array):
+    """Copy `array` into a new shared memory segment.
+
+    Returns
+    -------
+        The `SharedArray` description of the copy and the `SharedMemory` object of the segment."""
+    array = np.asarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return SharedArray(shm.name, array.shape, array.dtype.str), shm
+
+def fromShared(shared, unlink=False):
+    """Return a copy of the shared memory array `shared`. If `unlink` is True, the segment is freed."""
+    shm = shared_memory.SharedMemory(name=shared.name)
+    try:
+        return np.ndarray(shared.shape, dtype=shared.dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+def _work(function, shared, args):
+    """Run `function` on the shared memory image `shared` in a worker process. The arrays of the result are placed
+    into new shared memory segments."""
+    start = time.perf_counter()
+    # the function works on a private copy, the stages may keep references to their input after they finish
+    image = fromShared(shared)
+    value, arrays = function(image, *args)
+
+    sharedArrays = {}
+    for key, array in arrays.items():
+        sharedArrays[key], shm = toShared(array)
+        shm.close()
+
+    return value, sharedArrays, time.perf_counter() - start, os.getpid()
+
+class ParallelExecutor:
+    """Runs a function on many images in a pool of worker processes. The main process decodes the images into shared
+    memory segments, the workers read them from there instead of receiving them pickled through a pipe, and the arrays
+    of the results come back through shared memory as well. Only the small remaining parts of the results are pickled.
+    All the segments are unlinked by the main process.
+
+    The numbers of images processed by the individual workers and the time they spent on them are collected
+    in `workers` (see `throughput()`)."""
+    def __init__(self, jobs=None, prefetch=PREFETCH):
+        """Parameters
+        ----------
+        jobs : int
+            The number of worker processes. Defaults to the number of CPUs.
+        prefetch : int
+            The number of images per worker placed into shared memory ahead of the workers. Limits the memory
+            used for the waiting images. Defaults to `PREFETCH`."""
+        self.jobs = jobs or os.cpu_count() or 1
+        self.prefetch = max(prefetch, 1)
+        self.workers = {}
+        self.wallTime = 0.0
+
+    def map(self, function, items, load=np.asarray, args=()):
+        """Process `items` with `function` and yield the results in the order of `items`.
+
+        Parameters
+        ----------
+        function : function
+            Called in the workers as `function(image, *args)`. Returns a tuple of a picklable value and
+            a dictionary of numpy arrays. Must be a module level function.
+        items : iterable
+            The items (e.g. file paths) converted into the images by `load`.
+        load : function
+            Decodes an item into a numpy array in the main process. Defaults to `np.asarray`.
+        args : tuple
+            Additional picklable arguments of `function`.
+
+        Yields
+        ------
+            A `Result` for every item. If loading or processing the item raised an exception, the exception is its
+            `error` and the value is None."""
+        if os.name == "posix":
+            # the workers have to share the resource tracker of the main process, which unlinks their segments
+            resource_tracker.ensure_running()
+        start = time.perf_counter()
+        items = iter(items)
+        pending = deque()
+
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            try:
+                while True:
+                    while len(pending) < self.jobs * self.prefetch and self._submit(executor, function, items, load, args, pending):
+                        pass
+                    if not pending:
+                        break
+                    yield self._collect(*pending.popleft())
+            finally:
+                # the generator may be closed before all the results were collected
+                for job in pending:
+                    if job[1] is not None:
+                        job[1].cancel()
+                    self._collect(*job)
+                self.wallTime += time.perf_counter() - start
+
+    def _submit(self, executor, function, items, load, args, pending):
+        """Load the next item into shared memory and submit it. Returns False if there are no more items."""
+        try:
+            item = next(items)
+        except StopIteration:
+            return False
+
+        submitted = time.perf_counter()
+        try:
+            shared, shm = toShared(load(item))
+        except Exception as exc:
+            pending.append((item, None, None, exc, submitted))
+            return True
+
+        pending.append((item, executor.submit(_work, function, shared, args), shm, None, submitted))
+        return True
+
+    def _collect(self, item, future, shm, error, submitted):
+        """Wait for the result of a submitted item, copy its arrays out of shared memory and free the segments."""
+        if future is None:
+            return Result(item, None, {}, error, time.perf_counter() - submitted, None)
+
+        try:
+            with span("wait"):
+                value, sharedArrays, elapsed, worker = future.result()
+        except Exception as exc:
+            return Result(item, None, {}, exc, time.perf_counter() - submitted, None)
+        finally:
+            shm.close()
+            shm.unlink()
+
+        arrays = {key : fromShared(shared, unlink=True) for key, shared in sharedArrays.items()}
+        count, busy = self.workers.get(worker, (0, 0.0))
+        self.workers[worker] = (count + 1, busy + elapsed)
+
+        return Result(item, value, arrays, None, elapsed, worker)
+
+    def throughput(self):
+        """Return a dictionary with the throughput of every worker (by process ID) in images per second of its
+        busy time and the overall throughput in images per second of the wall time under the key None."""
+        rates = {worker : count / busy if busy > 0 else 0.0 for worker, (count, busy) in self.workers.items()}
+        total = sum(count for count, _ in self.workers.values())
+        rates[None] = total / self.wallTime if self.wallTime > 0 else 0.0
+        return rates
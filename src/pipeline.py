@@ -0,0 +1,231 @@
+"""Memoized graph of the fingerprint analysis stages.
+
+Author: Patrik Nemeth
+Xlogin: xnemet04
+School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
+"""
+import hashlib
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from normalize import normalizeMeanVariance
+from ridge_orientation import ridgeOrient
+from region_of_interest import getRoi
+from ridge_frequency import ridgeFreq
+from filters import gaborFilter, butterworth
+from thinning import zhangSuen
+from singularities import poincare, singularityCleanup
+from minutiae import extractMinutiae
+from fp_classes import getClass
+from points import inMask
+
+PIPELINE_CACHE_SIZE = 32    # number of stage results kept in the cache of a pipeline
+GABOR_THREADS = 1           # number of threads of the Gabor filtering of the default pipeline
+
+# the parameters of the stages, the defaults are the same as in the parameter window
+DEFAULT_PARAMS = {
+    "orientBlend" : 3,
+    "freqBlend" : 8,
+    "freqBlock" : 36,
+    "roiThresh" : 0.1,
+    "roiMode" : "sliding",  # the mode of `getRoi()` - "sliding" or "block"
+    "gaborSize" : 11,
+    "singularityBlend" : 14,
+    "dtype" : "float64",    # the datatype of the floating point images - "float64" or "float32"
+}
+
+# the input of the first stages
+IMAGE = "image"
+
+Stage = namedtuple("Stage", ["function", "inputs", "params"])
+
+def imageHash(image):
+    """Return a digest of the contents, shape and datatype of the array `image`."""
+    digest = hashlib.blake2b(np.ascontiguousarray(image).tobytes(), digest_size=16)
+    digest.update(str((image.shape, image.dtype.str)).encode())
+    return digest.hexdigest()
+
+def _freeze(value):
+    """Make the arrays in a stage result read-only, so a cached result cannot be changed by its users."""
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, tuple):
+        for item in value:
+            _freeze(item)
+
+class Pipeline:
+    """A graph of named stages with explicit dependencies. A stage is computed from the results of its input stages
+    and the values of the parameters it uses. The results are cached under a key made of the stage name, the values
+    of its parameters and the keys of its inputs, which end in the hash of the input image. Changing a parameter
+    or the image therefore only recomputes the stages, which depend on it.
+
+    The cache keeps at most `maxEntries` results and evicts the least recently used ones. The names of the
+    computed stages are appended to `computed` in the order of computation."""
+    def __init__(self, params=None, maxEntries=PIPELINE_CACHE_SIZE):
+        """Parameters
+        ----------
+        params : dict
+            The default values of the parameters. Defaults to `DEFAULT_PARAMS`.
+        maxEntries : int
+            The maximum number of cached results. Defaults to `PIPELINE_CACHE_SIZE`."""
+        self.stages = OrderedDict()
+        self.params = dict(DEFAULT_PARAMS if params is None else params)
+        self.maxEntries = maxEntries
+        self.computed = []
+
+        self._cache = OrderedDict()
+        self._image = None
+        self._imageKey = None
+
+    def addStage(self, name, function, inputs=(), params=()):
+        """Add a stage to the pipeline.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        function : function
+            Computes the stage as `function(*inputResults, **paramValues)`.
+        inputs : tuple
+            The names of the stages, whose results are the positional arguments of `function`. `IMAGE` stands
+            for the input image.
+        params : tuple
+            The names of the parameters passed to `function` as keyword arguments."""
+        for inputName in inputs:
+            if inputName != IMAGE and inputName not in self.stages:
+                raise ValueError("The stage \"" + str(inputName) + "\" is not recognised.")
+        self.stages[name] = Stage(function, tuple(inputs), tuple(params))
+
+    def setImage(self, image):
+        """Set the input image. The results of the previous images stay in the cache."""
+        self._image = image
+        self._imageKey = imageHash(image)
+
+    def clear(self):
+        """Remove all the cached results."""
+        self._cache.clear()
+
+    def get(self, name, **params):
+        """Return the result of the stage `name` for the current image.
+
+        Parameters
+        ----------
+        name : str
+            The name of the stage.
+        params : dict
+            The values of the parameters, which override the defaults in `params`.
+
+        Returns
+        -------
+            The result of the stage. Arrays in the result are read-only."""
+        if self._image is None:
+            raise ValueError("No input image is set.")
+        if name not in self.stages:
+            raise ValueError("The stage \"" + str(name) + "\" is not recognised.")
+
+        return self._compute(name, {**self.params, **params}, {})
+
+    def _key(self, name, params, keys):
+        """Return the cache key of stage `name`. `keys` memoizes the keys of the stages within one request."""
+        if name == IMAGE:
+            return self._imageKey
+        if name not in keys:
+            stage = self.stages[name]
+            keys[name] = (name, tuple((param, params[param]) for param in stage.params),
+                          tuple(self._key(inputName, params, keys) for inputName in stage.inputs))
+        return keys[name]
+
+    def _compute(self, name, params, keys):
+        """Return the result of stage `name` from the cache or compute it and its missing inputs."""
+        if name == IMAGE:
+            return self._image
+
+        key = self._key(name, params, keys)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        stage = self.stages[name]
+        inputs = [self._compute(inputName, params, keys) for inputName in stage.inputs]
+        value = stage.function(*inputs, **{param : params[param] for param in stage.params})
+        _freeze(value)
+
+        self._cache[key] = value
+        self.computed.append(name)
+        while len(self._cache) > self.maxEntries:
+            self._cache.popitem(last=False)
+
+        return value
+
+def _thin(filtim, mask):
+    """Thin the ridges of a Gabor filtered image within the region of interest."""
+    return zhangSuen((np.invert(filtim) * mask).astype(np.float32))
+
+def _singularities(orient, mask):
+    """Find, mask and clean up the cores and deltas of an orientation image."""
+    cores, deltas = poincare(orient, asPoints=True)
+    cores, deltas = inMask(cores, mask), inMask(deltas, mask)
+    return singularityCleanup(cores, deltas, mask)
+
+def defaultPipeline(params=None, maxEntries=PIPELINE_CACHE_SIZE, gaborThreads=GABOR_THREADS):
+    """Create the pipeline of the analyses of the application.
+
+    Stages
+    ------
+    normalized, butterworth
+        The normalized and the Butterworth filtered image.
+    normRoi, roi
+        The region of interest of the normalized and of the Butterworth filtered image.
+    normOrientation, flippedOrientation, orientation
+        The orientations of the normalized image (also flipped for plotting) and of the Butterworth filtered image.
+    normFrequency, frequency
+        The frequencies of the Butterworth filtered image with the orientations of the normalized and of the
+        Butterworth filtered image.
+    gabor, thinned, minutiae
+        The Gabor filtered image, the thinned image and the (bifurcations, ridge endings) point sets.
+    singularityOrientation, singularities, fpClass
+        The smoother orientations of the masked normalized image, the (cores, deltas) point sets and the class.
+
+    The floating point images are computed in the datatype given by the "dtype" parameter. With "float32" they take
+    half the memory and the FFTs of the Butterworth filter are done in complex64.
+
+    The number of threads of the Gabor filtering is the `gaborThreads` attribute of the pipeline. It does not change
+    the result, so it is not a parameter of the stage and changing it does not recompute the filtered image.
+
+    Returns
+    -------
+        A `Pipeline` with the stages above."""
+    pipeline = Pipeline(params, maxEntries)
+    pipeline.gaborThreads = gaborThreads
+
+    pipeline.addStage("normalized", normalizeMeanVariance, (IMAGE,))
+    pipeline.addStage("butterworth", lambda im, dtype: butterworth(im, dtype=dtype), ("normalized",), ("dtype",))
+    roi = lambda im, roiThresh, roiMode: getRoi(im, threshold=roiThresh, mode=roiMode)
+    pipeline.addStage("normRoi", roi, ("normalized",), ("roiThresh", "roiMode"))
+    pipeline.addStage("roi", roi, ("butterworth",), ("roiThresh", "roiMode"))
+
+    orientation = lambda im, orientBlend, dtype: ridgeOrient(im, blendSigma=orientBlend, dtype=dtype)
+    pipeline.addStage("normOrientation", orientation, ("normalized",), ("orientBlend", "dtype"))
+    pipeline.addStage("flippedOrientation", lambda im, orientBlend, dtype: ridgeOrient(im, blendSigma=orientBlend, flip=True, dtype=dtype),
+                      ("normalized",), ("orientBlend", "dtype"))
+    pipeline.addStage("orientation", orientation, ("butterworth",), ("orientBlend", "dtype"))
+
+    frequency = lambda im, orientim, freqBlend, freqBlock, dtype: ridgeFreq(im, orientim, blend_sigma=freqBlend, blocksize=freqBlock,
+                                                                            dtype=dtype)
+    pipeline.addStage("normFrequency", frequency, ("butterworth", "normOrientation"), ("freqBlend", "freqBlock", "dtype"))
+    pipeline.addStage("frequency", frequency, ("butterworth", "orientation"), ("freqBlend", "freqBlock", "dtype"))
+
+    pipeline.addStage("gabor", lambda im, orientim, freq, mask, gaborSize, dtype: gaborFilter(im, orientim, freq, mask, blocksize=gaborSize,
+                                                                                             threads=pipeline.gaborThreads, dtype=dtype),
+                      ("butterworth", "orientation", "frequency", "roi"), ("gaborSize", "dtype"))
+    pipeline.addStage("thinned", _thin, ("gabor", "roi"))
+    pipeline.addStage("minutiae", lambda thinned, mask: extractMinutiae(thinned, mask, asPoints=True), ("thinned", "roi"))
+
+    pipeline.addStage("singularityOrientation", lambda im, mask, singularityBlend, dtype: ridgeOrient(im * mask, blendSigma=singularityBlend,
+                                                                                                     dtype=dtype),
+                      ("normalized", "normRoi"), ("singularityBlend", "dtype"))  # better results with masked image
+    pipeline.addStage("singularities", _singularities, ("singularityOrientation", "normRoi"))
+    pipeline.addStage("fpClass", lambda singularities: getClass(*singularities), ("singularities",))
+
+    return pipeline
@@ -0,0 +1,149 @@
+"""Sparse point sets for singularities and minutiae.
+
+Author: Patrik Nemeth
+Xlogin: xnemet04
+School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
+"""
+import numpy as np
+
+# point types
+CORE = 0
+DELTA = 1
+BIFURCATION = 2
+RIDGE_ENDING = 3
+
+# a point set is a 1D structured array of this type
+POINT_DTYPE = np.dtype([("x", np.int32), ("y", np.int32), ("type", np.uint8)])
+
+def isPoints(obj):
+    """Return True if `obj` is a point set."""
+    return isinstance(obj, np.ndarray) and obj.dtype == POINT_DTYPE
+
+def makePoints(rows, cols, pointType):
+    """Create a point set.
+
+    Parameters
+    ----------
+    rows, cols : numpy_array
+        The row (y) and column (x) coordinates of the points.
+    pointType : int
+        The type of all the points. One of `CORE`, `DELTA`, `BIFURCATION` or `RIDGE_ENDING`.
+
+    Returns
+    -------
+        A point set with a point for every pair of `rows` and `cols`."""
+    points = np.zeros(np.size(rows), dtype=POINT_DTYPE)
+    points["y"] = rows
+    points["x"] = cols
+    points["type"] = pointType
+
+    return points
+
+def fromDense(img, pointType):
+    """Convert a dense image into a point set.
+
+    Parameters
+    ----------
+    img : numpy_array
+        A 2D array with nonzero values where the points are.
+    pointType : int
+        The type of all the points. One of `CORE`, `DELTA`, `BIFURCATION` or `RIDGE_ENDING`.
+
+    Returns
+    -------
+        A point set with the nonzero pixels of `img` in row-major order."""
+    rows, cols = np.nonzero(img)
+    return makePoints(rows, cols, pointType)
+
+def toDense(points, shape, dtype=np.float32):
+    """Convert a point set into a dense image.
+
+    Parameters
+    ----------
+    points : numpy_array
+        A point set.
+    shape : tuple
+        The shape of the output image.
+    dtype : numpy_dtype
+        The datatype of the output image. Defaults to float32.
+
+    Returns
+    -------
+        An array of shape `shape` with ones at the positions of the points and zeros elsewhere."""
+    img = np.zeros(shape, dtype=dtype)
+    img[points["y"], points["x"]] = 1
+
+    return img
+
+def sortPoints(points):
+    """Return the point set `points` sorted in row-major order - the order in which `np.nonzero` finds pixels."""
+    return points[np.lexsort((points["x"], points["y"]))]
+
+def inMask(points, mask):
+    """Return only the points of the point set `points`, which lie on nonzero pixels of `mask`."""
+    return points[mask[points["y"], points["x"]] != 0]
+
+class GridIndex:
+    """A uniform grid over a point set for finding close points without comparing all the pairs of points.
+    Every point is assigned to a square cell of size `cellSize` and the points are sorted by their cells,
+    so the points of any cell are found by a binary search."""
+    def __init__(self, points, cellSize):
+        """Parameters
+        ----------
+        points : numpy_array
+            The indexed point set.
+        cellSize : int
+            The size of the grid cells. Queries may only search up to this distance."""
+        self.points = points
+        self.cellSize = cellSize
+
+        # cell coordinates shifted by one, so the neighboring cells of the first row and column are not negative
+        self._width = int(points["x"].max()) // cellSize + 3 if points.size else 3
+        keys = self._keys(points)
+        self._order = np.argsort(keys, kind="stable")
+        self._keysSorted = keys[self._order]
+
+    def _keys(self, points):
+        """Return the cell keys of `points`."""
+        cellY = points["y"].astype(np.int64) // self.cellSize + 1
+        cellX = np.minimum(points["x"].astype(np.int64) // self.cellSize + 1, self._width - 2)
+        return cellY * self._width + cellX
+
+    def near(self, query, radius=None):
+        """Find all the pairs of points from `query` and the indexed points, which are closer than `radius`
+        in both coordinates (the chessboard distance).
+
+        Parameters
+        ----------
+        query : numpy_array
+            A point set.
+        radius : int
+            The distance. Must not be larger than the cell size. Defaults to the cell size.
+
+        Returns
+        -------
+            Two arrays of the same size with the indices of the close points in `query` and in the indexed points."""
+        if radius is None:
+            radius = self.cellSize
+        if radius > self.cellSize:
+            raise ValueError("The search radius is larger than the cell size of the grid index.")
+
+        queryKeys = self._keys(query)
+        queryIdx, indexIdx = [], []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                target = queryKeys + dy * self._width + dx
+                lo = np.searchsorted(self._keysSorted, target, side="left")
+                hi = np.searchsorted(self._keysSorted, target, side="right")
+                counts = hi - lo
+
+                # expand the [lo, hi) ranges of all the query points into one array of positions
+                positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+                queryIdx.append(np.repeat(np.arange(query.size), counts))
+                indexIdx.append(self._order[positions])
+
+        queryIdx, indexIdx = np.concatenate(queryIdx), np.concatenate(indexIdx)
+        close = ((np.abs(query["y"][queryIdx].astype(np.int64) - self.points["y"][indexIdx]) < radius) &
+                 (np.abs(query["x"][queryIdx].astype(np.int64) - self.points["x"][indexIdx]) < radius))
+
+        return queryIdx[close], indexIdx[close]
@@ -23,10 +23,20 @@ The software is provided "as is", without warranty of any kind, express or impli
 import numpy as np
 import scipy.ndimage as ndimage
 import scipy.signal as signal
+from numpy.lib import stride_tricks
 
 import exceptions as e
+from fields import BlockField, isField
+from lib import floatType
+from instrumentation import stage, span
 
-def ridgeFreq(im, orientim, blend_sigma=8, blocksize=36):
+FREQ_BATCH = 256    # number of blocks processed at once by the "batch" method
+SPECTRAL_BATCH = 256    # number of windows transformed at once by the "spectral" method
+SPECTRAL_FFT_SIZE = 64  # the windows are zero padded to at least this size before the transform
+
+@stage
+def ridgeFreq(im, orientim, blend_sigma=8, blocksize=36, method="batch", minFreq=1/25, maxFreq=1/3, asField=False,
+              dtype=np.float64):
     """Return ridge frequencies in image `im`.
     If no 'blend_sigma' is entered, the returned frequecy image is blocky. The 'blend_sigma' specifies a gaussian
     blur sigma value for blending the neighboring frequencies into a more continuous frequency image. If specified,
@@ -37,15 +47,39 @@ def ridgeFreq(im, orientim, blend_sigma=8, blocksize=36):
     ----------
     im : numpy_array
         The input fingerprint image.
-    orientim : numpy_array
-        Orientation image of the fingerprint. Values need to be in radians.
+    orientim : numpy_array, BlockField
+        Orientation image of the fingerprint. Values need to be in radians. An orientation field is interpolated
+        to full resolution.
     blend_sigma : int, float
         A scalar specifying the sigma of a gaussian blur. If given, the output image will result in a more continuous frequency estimation based on
         neighboring values of each pixel. Defaults to 8.
+    blocksize : int
+        The size of the blocks, in which the frequency is estimated. Defaults to 36.
+    method : str
+        Either "batch" or "rotate". The "rotate" method calls `freqest()` for every block. The "batch" method
+        samples the rotated sections of `FREQ_BATCH` blocks at once at precomputed coordinates with the same spline
+        interpolation as `ndimage.rotate()` and finds the peaks of all their x-signatures at once. Both methods
+        give the same frequencies up to floating point rounding. The "spectral" method reads the frequencies
+        from the spectra of overlapping windows of `im` - see `spectralOrientFreq()`. It does not use `orientim`.
+        Defaults to "batch".
+    minFreq : int, float
+        Low threshold of the accepted frequencies. Defaults to 1/25.
+    maxFreq : int, float
+        High threshold of the accepted frequencies. Defaults to 1/3.
+    asField : bool
+        If True, a `BlockField` with one frequency per block is returned instead of a full resolution image.
+        The blending is then done on the blocks with a sigma of `blend_sigma` / `blocksize`. Defaults to False.
+    dtype : numpy_dtype
+        Either float64 or float32. The datatype of the full resolution frequency image, which is blended in it.
+        The frequencies of the blocks are always estimated in float64. Defaults to float64.
     
     Returns
     -------
-        A numpy array of the same size as `im`, which contains the local papillary ridge frequencies."""
+        A numpy array of the same size as `im`, which contains the local papillary ridge frequencies,
+        or a `BlockField` if `asField` is True."""
+    if isField(orientim):
+        orientim = orientim.toDense(interpolate=True)
+
     if not isinstance(im, np.ndarray):
         raise e.InvalidDataType("The input image is not a numpy array.")
     if not isinstance(orientim, np.ndarray):
@@ -60,16 +94,33 @@ def ridgeFreq(im, orientim, blend_sigma=8, blocksize=36):
         if not (isinstance(blend_sigma, int) or isinstance(blend_sigma, float)):
             raise e.InvalidDataType("The `blend_sigma` parameter is not an int or float.")
 
+    dtype = floatType(dtype)
+
     rows, cols = im.shape
-    freq = np.zeros((rows, cols))
 
-    for r in range(0,rows-blocksize, blocksize):
-        for c in range(0,cols-blocksize, blocksize):
-            orientBlk = orientim[r:r+blocksize, c:c+blocksize]
-            imBlk = im[r:r+blocksize, c:c+blocksize]
+    if method == "batch":
+        field = BlockField(_ridgeFreqBatch(im, orientim, blocksize, minFreq, maxFreq), blocksize, im.shape, fill=0)
+    elif method == "spectral":
+        _, field = spectralOrientFreq(im, blocksize, minFreq, maxFreq, asField=True)
+    elif method == "rotate":
+        blockFreq = np.zeros(_blocks(im, blocksize).shape[:2])
+
+        for i, r in enumerate(range(0,rows-blocksize, blocksize)):
+            for j, c in enumerate(range(0,cols-blocksize, blocksize)):
+                orientBlk = orientim[r:r+blocksize, c:c+blocksize]
+                imBlk = im[r:r+blocksize, c:c+blocksize]
 
-            freq[r:r+blocksize, c:c+blocksize] = freqest(imBlk, orientBlk)
+                blockFreq[i, j] = freqest(imBlk, orientBlk, minFreq, maxFreq)[0, 0]
+        field = BlockField(blockFreq, blocksize, im.shape, fill=0)
+    else:
+        raise e.InvalidParameterValue("The specified frequency estimation method is not recognised.")
+
+    if asField:
+        if blend_sigma != None:
+            field.values = ndimage.gaussian_filter(field.values, blend_sigma / field.blocksize)
+        return field
 
+    freq = field.toDense(dtype=dtype)
     if blend_sigma == None:
         return freq
     else:
@@ -130,3 +181,221 @@ def freqest(im, orientim, minFreq=1/25, maxFreq=1/3):
         return freq * np.ones((rows,cols))
     else:
         return np.zeros((rows,cols))
+
+def _blocks(im, blocksize):
+    """Return the blocks of `im` processed by `ridgeFreq()` as a strided view of shape
+    (block rows, block columns, `blocksize`, `blocksize`)."""
+    rows, cols = im.shape
+    shape = (len(range(0, rows-blocksize, blocksize)), len(range(0, cols-blocksize, blocksize)), blocksize, blocksize)
+    strides = (blocksize * im.strides[0], blocksize * im.strides[1]) + im.strides
+
+    return stride_tricks.as_strided(im, shape=shape, strides=strides)
+
+def _findPeaks(signals):
+    """Find the peaks of every row of `signals` the same way as `signal.find_peaks()` without any conditions.
+    The peak of a flat top is in its middle, rounded down.
+
+    Returns
+    -------
+        A boolean array of the same shape as `signals`, which is True at the peaks."""
+    rows, cols = signals.shape
+    columns = np.arange(cols)
+
+    # last column of the run of equal values every sample belongs to
+    change = signals[:, 1:] != signals[:, :-1]
+    runEnd = np.where(change, columns[:-1], cols - 1)
+    runEnd = np.concatenate((runEnd, np.full((rows, 1), cols - 1)), axis=1)
+    runEnd = np.minimum.accumulate(runEnd[:, ::-1], axis=1)[:, ::-1]
+
+    # a peak is a run, which rises from the left and falls to the right of it
+    starts = columns[1:-1]
+    ends = runEnd[:, 1:-1]
+    rises = signals[:, :-2] < signals[:, 1:-1]
+    falls = np.take_along_axis(signals, np.minimum(ends + 1, cols - 1), axis=1) < signals[:, 1:-1]
+    isPeak = rises & falls & (ends < cols - 1)
+
+    peakRows, peakStarts = np.nonzero(isPeak)
+    peaks = np.zeros(signals.shape, dtype=bool)
+    peaks[peakRows, (starts[peakStarts] + ends[peakRows, peakStarts]) // 2] = True
+
+    return peaks
+
+def _ridgeFreqBatch(im, orientim, blocksize, minFreq=1/25, maxFreq=1/3):
+    """The "batch" method of `ridgeFreq()`. Does the same as `freqest()` for all the blocks at once.
+
+    Returns
+    -------
+        A 2D array with the frequency of every block."""
+    imBlocks = _blocks(im, blocksize)
+    blockRows, blockCols = imBlocks.shape[:2]
+    if blockRows == 0 or blockCols == 0:
+        return np.zeros((blockRows, blockCols))
+    imBlocks = imBlocks.reshape((-1, blocksize, blocksize))
+    orientBlocks = _blocks(orientim, blocksize).reshape((-1, blocksize, blocksize))
+
+    # average orientation of every block
+    orientBlocks = orientBlocks * 2
+    cosorient = np.mean(np.cos(orientBlocks), axis=(1,2))
+    sinorient = np.mean(np.sin(orientBlocks), axis=(1,2))
+    orient = np.arctan2(sinorient, cosorient) / 2
+
+    # + 90 degrees, as the section needs to be orthogonal towards the ridges
+    angle = np.deg2rad(orient / np.pi * 180 + 90).reshape((-1, 1, 1))
+
+    # coordinates of the cropped section relative to the center of the block - rotating them into the block
+    #   samples the same pixels as rotating the block with `ndimage.rotate()` and cropping it
+    cropsze = int(np.fix(blocksize/np.sqrt(2)))
+    offset = int(np.fix((blocksize-cropsze)/2))
+    center = (blocksize - 1) / 2
+    cropY, cropX = np.indices((cropsze, cropsze)) + offset - center
+
+    blockFreq = np.zeros(imBlocks.shape[0])
+    for start in range(0, imBlocks.shape[0], FREQ_BATCH):
+        with span("batch", blocks=min(FREQ_BATCH, imBlocks.shape[0] - start)):
+            stack = imBlocks[start:start+FREQ_BATCH]
+            cos, sin = np.cos(angle[start:start+FREQ_BATCH]), np.sin(angle[start:start+FREQ_BATCH])
+            rotY = cos * cropY + sin * cropX + center
+            rotX = -sin * cropY + cos * cropX + center
+
+            # spline coefficients of every block on its own, as `ndimage.rotate()` computes them, stacked into
+            #   a single column of blocks with a mirrored border wide enough for the cubic spline
+            coeffs = ndimage.spline_filter1d(stack, 3, axis=1, output=np.float64, mode="mirror")
+            coeffs = ndimage.spline_filter1d(coeffs, 3, axis=2, mode="mirror")
+            coeffs = np.pad(coeffs, ((0,0), (2,2), (2,2)), mode="reflect")
+            mosaic = coeffs.reshape((-1, blocksize+4))
+
+            mosaicY = rotY + 2 + (blocksize+4) * np.arange(stack.shape[0]).reshape((-1, 1, 1))
+            rotim = ndimage.map_coordinates(mosaic, [mosaicY, rotX + 2], output=im.dtype, order=3, prefilter=False)
+            # the corners of the section may fall just outside of the block, where `ndimage.rotate()` gives zeros
+            rotim[(rotY < 0) | (rotY > blocksize-1) | (rotX < 0) | (rotX > blocksize-1)] = 0
+
+            x_sig = np.sum(rotim, axis=1) # sum along the columns to get x-signature
+
+            # the mean peak distance is the distance between the first and the last peak divided by the number
+            #   of gaps between the peaks
+            peaks = _findPeaks(x_sig)
+            count = np.sum(peaks, axis=1)
+            first = np.argmax(peaks, axis=1)
+            last = peaks.shape[1] - 1 - np.argmax(peaks[:, ::-1], axis=1)
+
+            valid = count > 1
+            batchFreq = np.zeros(stack.shape[0])
+            batchFreq[valid] = 1 / ((last[valid] - first[valid]) / (count[valid] - 1))
+
+            # threshold the frequencies
+            batchFreq[(batchFreq <= minFreq) | (batchFreq >= maxFreq)] = 0
+            blockFreq[start:start+FREQ_BATCH] = batchFreq
+
+    return blockFreq.reshape((blockRows, blockCols))
+
+def _logPower(power, y, x):
+    """Return the logarithm of the one-sided power spectra `power` (windows, y frequencies, x frequencies) at
+    position (`y`[i], `x`[i]) of every window i. The y frequencies wrap around and the negative x frequencies
+    are mirrored through the origin."""
+    mirrored = x < 0
+    y, x = np.where(mirrored, -y, y) % power.shape[1], np.abs(x)
+    return np.log(power[np.arange(power.shape[0]), y, x] + np.finfo(np.float64).tiny)
+
+@stage
+def spectralOrientFreq(im, blocksize=36, minFreq=1/25, maxFreq=1/3, asField=False):
+    """Estimate the ridge orientations and frequencies of image `im` in a single pass from the spectra of
+    overlapping windows. The windows of size `blocksize` are taken every `blocksize // 2` pixels, weighted by a Hann
+    window and zero padded to `SPECTRAL_FFT_SIZE`. The strongest peak of a spectrum within the band of the accepted
+    frequencies gives the ridge frequency (its distance from the origin) and the ridge orientation (perpendicular
+    to its direction). The peak position is refined by interpolating a parabola through the log spectrum.
+
+    Parameters
+    ----------
+    im : numpy_array
+        The input fingerprint image.
+    blocksize : int
+        The size of the windows. Defaults to 36.
+    minFreq : int, float
+        Low threshold of the accepted frequencies. Defaults to 1/25.
+    maxFreq : int, float
+        High threshold of the accepted frequencies. Defaults to 1/3.
+    asField : bool
+        If True, the orientations and frequencies are returned as `BlockField`s with a block for the center
+        tile of every window instead of full resolution images. Defaults to False.
+
+    Returns
+    -------
+        Two arrays of the same size as `im` - a blocky orientation image with values from 0 to Pi in the same
+        convention as `ridgeOrient()` and a blocky frequency image with zeros, where no frequency was accepted."""
+    if not isinstance(im, np.ndarray):
+        raise e.InvalidDataType("The input image is not a numpy array.")
+
+    if im.ndim != 2:
+        raise e.InvalidInputImageDimensions("The input image is not a 2D numpy array.")
+
+    rows, cols = im.shape
+    step = max(blocksize // 2, 1)
+    border = (blocksize - step) // 2
+
+    # overlapping windows as a strided view
+    windowRows = max((rows - blocksize) // step + 1, 0)
+    windowCols = max((cols - blocksize) // step + 1, 0)
+    if windowRows == 0 or windowCols == 0:
+        orient = BlockField(np.zeros((0, 0)), step, im.shape, border, angular=True)
+        freq = BlockField(np.zeros((0, 0)), step, im.shape, border)
+        return (orient, freq) if asField else (orient.toDense(), freq.toDense())
+
+    strides = (step * im.strides[0], step * im.strides[1]) + im.strides
+    windows = stride_tricks.as_strided(im, shape=(windowRows, windowCols, blocksize, blocksize), strides=strides)
+    windows = windows.reshape((-1, blocksize, blocksize))
+
+    size = max(SPECTRAL_FFT_SIZE, int(2 ** np.ceil(np.log2(blocksize))))
+    hann = np.outer(np.hanning(blocksize), np.hanning(blocksize))
+
+    # the accepted band of the spectrum - only the half with nonnegative x frequencies, the other is symmetric
+    freqY = np.fft.fftfreq(size).reshape((-1, 1))
+    freqX = np.fft.rfftfreq(size).reshape((1, -1))
+    radius = np.hypot(freqY, freqX)
+    outOfBand = (radius <= minFreq) | (radius >= maxFreq)
+
+    blockOrient = np.zeros(windows.shape[0])
+    blockFreq = np.zeros(windows.shape[0])
+    for start in range(0, windows.shape[0], SPECTRAL_BATCH):
+        with span("batch", windows=min(SPECTRAL_BATCH, windows.shape[0] - start)):
+            batch = windows[start:start+SPECTRAL_BATCH]
+            batch = (batch - np.mean(batch, axis=(1,2), keepdims=True)) * hann
+
+            spectrum = np.fft.rfft2(batch, s=(size, size))
+            power = spectrum.real ** 2 + spectrum.imag ** 2
+            inBand = np.where(outOfBand, 0, power)
+
+            peak = np.argmax(inBand.reshape((batch.shape[0], -1)), axis=1)
+            peakY, peakX = np.unravel_index(peak, outOfBand.shape)
+
+            # sub-bin position of the peak from a parabola through the log spectrum along each axis
+            center = _logPower(power, peakY, peakX)
+            offsets = []
+            isMaximum = center > np.log(np.finfo(np.float64).tiny)
+            for dy, dx in [(1, 0), (0, 1)]:
+                # the log spectrum one bin before and one bin after the peak along the axis
+                before = _logPower(power, peakY - dy, peakX - dx)
+                after = _logPower(power, peakY + dy, peakX + dx)
+                curvature = before - 2 * center + after
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    offset = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0)
+                offsets.append(np.clip(offset, -0.5, 0.5))
+                isMaximum &= (center >= before) & (center >= after)
+
+            fy = freqY[peakY, 0] + offsets[0] / size
+            fx = freqX[0, peakX] + offsets[1] / size
+            batchFreq = np.hypot(fy, fx)
+
+            # reject windows without any ridges and windows, where the strongest frequency lies outside of the band
+            #   and only its slope reaches into the band
+            valid = isMaximum & (batchFreq > minFreq) & (batchFreq < maxFreq)
+            blockFreq[start:start+SPECTRAL_BATCH] = np.where(valid, batchFreq, 0)
+            # the peak points across the ridges, the orientation is perpendicular to it
+            blockOrient[start:start+SPECTRAL_BATCH] = np.mod(np.arctan2(fy, fx) + np.pi / 2, np.pi)
+
+    # every window covers the step x step tile in its center, the tiles at the borders are extended to the edges
+    orient = BlockField(blockOrient.reshape((windowRows, windowCols)), step, im.shape, border, angular=True)
+    freq = BlockField(blockFreq.reshape((windowRows, windowCols)), step, im.shape, border)
+    if asField:
+        return orient, freq
+
+    return orient.toDense(), freq.toDense()
@@ -6,7 +6,17 @@ School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
 """
 import numpy as np
 from numpy.lib import stride_tricks
+from scipy import ndimage, sparse
 from scipy.ndimage.measurements import center_of_mass
+from scipy.sparse.csgraph import connected_components
+
+import exceptions as e
+import points as pts
+from fields import isField
+from instrumentation import stage
+
+# offsets of the "circle" around a pixel used for the Poincare index, the last item == first item
+RING_OFFSETS = ((1, 0), (1, -1), (0, -1), (-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0))
 
 def poincareIndex(window):
     """Calculate the poincare index of the center pixel in `window`.
@@ -40,7 +50,8 @@ def poincareIndex(window):
 
     return (1 / np.pi) * np.sum(betas)  # return the poincare index of this window
 
-def poincare(img):
+@stage
+def poincare(img, asPoints=False):
     """Find cores and deltas in the fingerprint image based on the Poincare index.
     Based on:
     Iwasokun, G. a Akinyokun, O. Fingerprint Singular Point Detection Based on
@@ -49,33 +60,66 @@ def poincare(img):
 
     Parameters
     ----------
-    img : numpy_array
-        A 2D array representing the orientations of the ridges at every pixel.
+    img : numpy_array, BlockField
+        A 2D array representing the orientations of the ridges at every pixel, or an orientation field, which is
+        interpolated to full resolution.
+    asPoints : bool
+        If True, the cores and deltas are returned as point sets (see `points.py`) instead of dense arrays.
+        Defaults to False.
 
     Returns
     -------
         Two binary 2D arrays of the same size as `img` with non-zero values where based on the Poincare index
         cores or deltas were found. The first returned array represents the cores and the second the deltas."""
-    # TODO try to calculate the poincare indices via these patches - may be faster than a nested loop
-    size = 3
-    shape = (img.shape[0] - size + 1, img.shape[1] - size + 1, size, size)
-    strides = 2 * img.strides
-    patches = stride_tricks.as_strided(img, shape=shape, strides=strides)
-
-    deltas = np.zeros_like(img).astype(np.float32)
-    cores = np.zeros_like(img).astype(np.float32)
-    for i in range(1, img.shape[0] - 1):
-        for j in range(1, img.shape[1] - 1):
-            window = img[i-1:i+2, j-1:j+2]   # take a 3x3 window around the current pixel
-            Pc = poincareIndex(window)
-            # for some reason this condition is flipped in comparison to checked research sources (??)
-            if Pc >= -1 and Pc <= -0.5:
-                deltas[i,j] = 1
-            if Pc >= 0.5 and Pc <= 1:
-                cores[i,j] = 1
+    rows, cols = img.shape
+    if rows < 3 or cols < 3:
+        if asPoints:
+            return (pts.makePoints([], [], pts.CORE), pts.makePoints([], [], pts.DELTA))
+        return (np.zeros(img.shape, dtype=np.float32), np.zeros(img.shape, dtype=np.float32))
+
+    if isField(img):
+        img = img.toDense(interpolate=True)
+
+    # the "circle" around every inner pixel as 9 shifted views of the image, the last one == the first one
+    ring = [img[1+dr : rows-1+dr, 1+dc : cols-1+dc] for dr, dc in RING_OFFSETS]
+    Pc = poincareIndices(ring)
+
+    # for some reason this condition is flipped in comparison to checked research sources (??)
+    isDelta = (Pc >= -1) & (Pc <= -0.5)
+    isCore = (Pc >= 0.5) & (Pc <= 1)
+
+    if asPoints:
+        coreIdx, deltaIdx = np.nonzero(isCore), np.nonzero(isDelta)
+        return (pts.makePoints(coreIdx[0] + 1, coreIdx[1] + 1, pts.CORE), pts.makePoints(deltaIdx[0] + 1, deltaIdx[1] + 1, pts.DELTA))
+
+    deltas = np.zeros(img.shape, dtype=np.float32)
+    cores = np.zeros(img.shape, dtype=np.float32)
+    deltas[1:-1, 1:-1] = isDelta
+    cores[1:-1, 1:-1] = isCore
 
     return (cores, deltas)
 
+def poincareIndices(ring):
+    """Calculate the poincare indices of many pixels at once. Gives exactly the same values as `poincareIndex()`.
+
+    Parameters
+    ----------
+    ring : list
+        9 arrays of the same shape with the orientations around the pixels in the order of `RING_OFFSETS`.
+
+    Returns
+    -------
+        An array of the same shape as the items of `ring` with the Poincare index of each pixel."""
+    betas = []
+    for before, after in zip(ring[:-1], ring[1:]):
+        diffs = after - before
+        beta = np.where(diffs <= -np.pi/2, diffs + np.pi, np.where(diffs <= np.pi/2, diffs, diffs - np.pi))
+        betas.append(beta.astype(np.float64))
+
+    # summed in the same order as `np.sum` adds 8 values, so the indices match `poincareIndex` exactly
+    b = betas
+    return (1 / np.pi) * (((b[0] + b[1]) + (b[2] + b[3])) + ((b[4] + b[5]) + (b[6] + b[7])))
+
 def averageSingularities(sings, regionSize=8):
     """Reduce the number of singularities in `sings` in region of size `regionSize`. If multiple singularities
     are found in a region, take the average position of the singularities and replace them with this one average
@@ -84,15 +128,19 @@ def averageSingularities(sings, regionSize=8):
     Parameters
     ----------
     sings : numpy_array
-        A 2D binary array with nonzero values in fields where singularities were found. This variable has to contain
-        only one type of singularity - either only cores or only deltas.
+        A 2D binary array with nonzero values in fields where singularities were found, or a point set.
+        This variable has to contain only one type of singularity - either only cores or only deltas.
     regionSize : int
         The size of the region around each found singularity, from which the average will be computed.
         Defaults to 8.
 
     Returns
     -------
-        A binary 2D array of the same size as `sings`, but with averaged positions of the singularities."""
+        A binary 2D array of the same size as `sings`, but with averaged positions of the singularities.
+        If `sings` is a point set, a new point set is returned instead."""
+    if pts.isPoints(sings):
+        return _averagePoints(sings, regionSize)
+
     left = right = up = down = regionSize
     shape = sings.shape
 
@@ -123,6 +171,26 @@ def averageSingularities(sings, regionSize=8):
     
     return sings
 
+def _averagePoints(sings, regionSize):
+    """`averageSingularities()` for point sets. The points are processed in the same order and with the same
+    regions as the pixels of a dense array, so the results are the same."""
+    sings = pts.sortPoints(sings)
+    current = sings.copy()
+
+    for i, j in zip(sings["y"], sings["x"]):
+        # the regions reaching over the borders of the image would be clipped - no points lie there anyway
+        inRegion = ((current["y"] >= i - regionSize) & (current["y"] < i + regionSize) &
+                    (current["x"] >= j - regionSize) & (current["x"] < j + regionSize))
+
+        if np.count_nonzero(inRegion) > 1:
+            # the integer part of the center of mass
+            average = current[inRegion][:1].copy()
+            average["y"] = np.floor(np.mean(current["y"][inRegion]))
+            average["x"] = np.floor(np.mean(current["x"][inRegion]))
+            current = np.concatenate((current[~inRegion], average))
+
+    return pts.sortPoints(current)
+
 def deleteSingularities(cores, deltas, regionSize=8):
     """Delete singularities of both types if within the same region of size `regionSize`.
     The size of both `cores` and `deltas` must match.
@@ -130,9 +198,9 @@ def deleteSingularities(cores, deltas, regionSize=8):
     Parameters
     ----------
     cores : numpy_array
-        A 2D binary array with nonzero values in fields where cores were found.
+        A 2D binary array with nonzero values in fields where cores were found, or a point set of cores.
     deltas : numpy_array
-        A 2D binary array with nonzero values in fields where deltas were found.
+        A 2D binary array with nonzero values in fields where deltas were found, or a point set of deltas.
     regionSize : int
         The size of the region around each found singularity, in which the singularities will be deleted.
         Defaults to 8.
@@ -140,7 +208,11 @@ def deleteSingularities(cores, deltas, regionSize=8):
     Returns
     -------
         Returns `cores` and `deltas` in this order, only with non-zero values zeroed out where markers for
-        their respective singularities were found in the same region."""
+        their respective singularities were found in the same region. Point sets are returned as new point sets
+        without the deleted points."""
+    if pts.isPoints(cores):
+        return _deleteSingularityPoints(cores, deltas, regionSize)
+
     left = right = up = down = regionSize
     shape = cores.shape
 
@@ -169,14 +241,32 @@ def deleteSingularities(cores, deltas, regionSize=8):
 
     return cores, deltas
 
+def _deleteSingularityPoints(cores, deltas, regionSize):
+    """`deleteSingularities()` for point sets, with the same results as for dense arrays."""
+    cores = pts.sortPoints(cores)
+    keepCores = np.ones(cores.size, dtype=bool)
+    keepDeltas = np.ones(deltas.size, dtype=bool)
+
+    for i, j in zip(cores["y"], cores["x"]):
+        coreRegion = ((cores["y"] >= i - regionSize) & (cores["y"] < i + regionSize) &
+                      (cores["x"] >= j - regionSize) & (cores["x"] < j + regionSize))
+        deltaRegion = ((deltas["y"] >= i - regionSize) & (deltas["y"] < i + regionSize) &
+                       (deltas["x"] >= j - regionSize) & (deltas["x"] < j + regionSize))
+
+        if np.any(coreRegion & keepCores) and np.any(deltaRegion & keepDeltas):
+            keepCores &= ~coreRegion
+            keepDeltas &= ~deltaRegion
+
+    return cores[keepCores], deltas[keepDeltas]
+
 def deleteNearMask(sings, mask, regionSize=10):
     """Delete singularities near the edge of a region of interest mask.
 
     Parameters
     ----------
     sings : numpy_array
-        A 2D binary array with nonzero values in fields where singularities were found. This variable has to contain
-        only one type of singularity - either only cores or only deltas.
+        A 2D binary array with nonzero values in fields where singularities were found, or a point set.
+        This variable has to contain only one type of singularity - either only cores or only deltas.
     mask : numpy_array
         A 2D binary array with nonzero values denoting the region of interest.
     regionSize : int
@@ -185,15 +275,22 @@ def deleteNearMask(sings, mask, regionSize=10):
 
     Returns
     -------
-        A binary 2D array of the same size as `sings`, but with deleted singularities near the ROI `mask`."""
+        A binary 2D array of the same size as `sings`, but with deleted singularities near the ROI `mask`.
+        If `sings` is a point set, a new point set is returned instead."""
     left = right = up = down = regionSize
-    rows, cols = np.nonzero(sings)
+    isPoints = pts.isPoints(sings)
+    if isPoints:
+        sings = pts.sortPoints(sings)
+        rows, cols = sings["y"], sings["x"]
+        keep = np.ones(sings.size, dtype=bool)
+    else:
+        rows, cols = np.nonzero(sings)
 
     mask = np.invert(mask.astype(np.bool))
 
-    shape = sings.shape
+    shape = mask.shape
 
-    for i, j in zip(rows, cols):
+    for idx, (i, j) in enumerate(zip(rows, cols)):
         # if near borders, set the regions, so that they do not reach out of bounds
         if i - left < 0:
             left = i
@@ -207,11 +304,104 @@ def deleteNearMask(sings, mask, regionSize=10):
 
         # if near mask, remove singularity
         if np.sum(mask[i-left : i+right, j-up : j+down]) != 0:
-            sings[i,j] = 0
+            if isPoints:
+                keep[idx] = False
+            else:
+                sings[i,j] = 0
 
+    if isPoints:
+        return sings[keep]
     return sings
 
-def singularityCleanup(cores, deltas, mask=None):
+def clusterPoints(sings, regionSize=8):
+    """Replace every cluster of singularities with one singularity at the average position of the cluster.
+    Two singularities belong to the same cluster if they are closer than `regionSize` in both coordinates,
+    or if they are connected by a chain of such singularities. Unlike `averageSingularities()`, the result
+    does not depend on the order of the singularities.
+
+    Parameters
+    ----------
+    sings : numpy_array
+        A point set with only one type of singularity.
+    regionSize : int
+        The distance of singularities in one cluster. Defaults to 8.
+
+    Returns
+    -------
+        A new point set with one point per cluster, in row-major order."""
+    if sings.size < 2:
+        return sings.copy()
+
+    first, second = pts.GridIndex(sings, regionSize).near(sings)
+    graph = sparse.coo_matrix((np.ones(first.size), (first, second)), shape=(sings.size, sings.size))
+    count, labels = connected_components(graph, directed=False)
+
+    sizes = np.bincount(labels, minlength=count)
+    clustered = sings[np.unique(labels, return_index=True)[1]].copy()
+    clustered["y"] = np.floor(np.bincount(labels, weights=sings["y"], minlength=count) / sizes)
+    clustered["x"] = np.floor(np.bincount(labels, weights=sings["x"], minlength=count) / sizes)
+
+    return pts.sortPoints(clustered)
+
+def cancelPairs(cores, deltas, regionSize=8):
+    """Delete all the cores and deltas, which have a singularity of the other type closer than `regionSize`
+    in both coordinates. Unlike `deleteSingularities()`, the result does not depend on the order of the singularities.
+
+    Parameters
+    ----------
+    cores : numpy_array
+        A point set of cores.
+    deltas : numpy_array
+        A point set of deltas.
+    regionSize : int
+        The distance of singularities, which cancel each other out. Defaults to 8.
+
+    Returns
+    -------
+        New point sets of `cores` and `deltas` in this order without the cancelled singularities."""
+    coreIdx, deltaIdx = pts.GridIndex(deltas, regionSize).near(cores)
+
+    keepCores = np.ones(cores.size, dtype=bool)
+    keepDeltas = np.ones(deltas.size, dtype=bool)
+    keepCores[coreIdx] = False
+    keepDeltas[deltaIdx] = False
+
+    return cores[keepCores], deltas[keepDeltas]
+
+def maskDistance(mask):
+    """Precompute the chessboard distance of every pixel to the nearest pixel outside of the region of interest.
+
+    Parameters
+    ----------
+    mask : numpy_array
+        A 2D binary array with nonzero values denoting the region of interest.
+
+    Returns
+    -------
+        An integer array of the same size as `mask`. Pixels outside of the region of interest are zero."""
+    return ndimage.distance_transform_cdt(mask != 0, metric="chessboard")
+
+def deleteNearMaskDistance(sings, distance, regionSize=10):
+    """Delete the points of the point set `sings`, which are at most `regionSize` away from the edge of the
+    region of interest. This is the distance transform counterpart of `deleteNearMask()`, which works in
+    constant time per point.
+
+    Parameters
+    ----------
+    sings : numpy_array
+        A point set.
+    distance : numpy_array
+        The distance transform of the region of interest as returned by `maskDistance()`.
+    regionSize : int
+        The distance from the edge of the region of interest, in which the points are deleted. Defaults to 10.
+
+    Returns
+    -------
+        A new point set without the points near the edge of the region of interest."""
+    return sings[distance[sings["y"], sings["x"]] > regionSize]
+
+@stage
+def singularityCleanup(cores, deltas, mask=None, method="sequential"):
     """Calls `averageSingularities` and `deleteSingularities` in this order in order to clean up
     the singularity images.
     Based on:
@@ -222,15 +412,26 @@ def singularityCleanup(cores, deltas, mask=None):
     Parameters
     ----------
     cores : numpy_array
-        A 2D binary array with nonzero values in fields where cores were found.
+        A 2D binary array with nonzero values in fields where cores were found, or a point set of cores.
     deltas : numpy_array
-        A 2D binary array with nonzero values in fields where deltas were found.
+        A 2D binary array with nonzero values in fields where deltas were found, or a point set of deltas.
     mask : numpy_array
         A 2D binary array with nonzero values denoting the region of interest.
+    method : str
+        Either "sequential" or "grid". The "sequential" method calls the functions above, which process
+        the singularities one by one in row-major order. The "grid" method uses `clusterPoints()`, `cancelPairs()`
+        and `deleteNearMaskDistance()` instead, which find close singularities via a grid index and do not
+        depend on the order of the singularities. The results of the methods may differ slightly. Defaults
+        to "sequential".
 
     Returns
     -------
         The cleaned versions of `cores` and `deltas` in this order."""
+    if method == "grid":
+        return _gridCleanup(cores, deltas, mask)
+    elif method != "sequential":
+        raise e.InvalidParameterValue("The specified singularity cleanup method is not recognised.")
+
     cores = averageSingularities(cores)
     deltas = averageSingularities(deltas)
 
@@ -240,4 +441,25 @@ def singularityCleanup(cores, deltas, mask=None):
         cores = deleteNearMask(cores, mask)
         deltas = deleteNearMask(deltas, mask)
 
-    return cores, deltas
\ No newline at end of file
+    return cores, deltas
+
+def _gridCleanup(cores, deltas, mask):
+    """The "grid" method of `singularityCleanup()`. Dense arrays are converted to point sets and back."""
+    dense = not pts.isPoints(cores)
+    if dense:
+        shape = cores.shape
+        cores, deltas = pts.fromDense(cores, pts.CORE), pts.fromDense(deltas, pts.DELTA)
+
+    cores = clusterPoints(cores)
+    deltas = clusterPoints(deltas)
+
+    cores, deltas = cancelPairs(cores, deltas)
+
+    if not isinstance(mask, type(None)):
+        distance = maskDistance(mask)
+        cores = deleteNearMaskDistance(cores, distance)
+        deltas = deleteNearMaskDistance(deltas, distance)
+
+    if dense:
+        return pts.toDense(cores, shape), pts.toDense(deltas, shape)
+    return cores, deltas
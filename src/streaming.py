@@ -0,0 +1,128 @@
+"""Streaming of batches with the reading and writing running concurrently with the processing.
+
+Author: Patrik Nemeth
+Xlogin: xnemet04
+School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
+"""
+import threading
+from queue import Queue, Full
+
+from instrumentation import attach, currentTrace
+
+STREAM_PREFETCH = 4     # number of decoded items waiting for the processing
+STREAM_BACKLOG = 4      # number of results waiting for the writer
+
+_DONE = object()        # marks the end of a queue
+
+def _put(queue, entry, stop):
+    """Put `entry` into the bounded `queue`, blocking while it is full. Returns False if `stop` was set
+    in the meantime and the entry was not put."""
+    while True:
+        try:
+            queue.put(entry, timeout=0.1)
+            return True
+        except Full:
+            if stop.is_set():
+                return False
+
+def readAhead(items, load, size=STREAM_PREFETCH):
+    """Load `items` in a background thread, while the caller processes the previous ones.
+
+    At most `size` loaded items wait for the caller. When they are not taken, the reader blocks, so the memory
+    used by the loaded items stays bounded however long `items` is.
+
+    Parameters
+    ----------
+    items : iterable
+        The items (e.g. file paths) to be loaded.
+    load : function
+        Loads an item (e.g. decodes an image file).
+    size : int
+        The maximum number of loaded items waiting for the caller. Defaults to `STREAM_PREFETCH`.
+
+    Yields
+    ------
+        A (item, value, error) tuple for every item in the order of `items`. If `load` raised an exception,
+        the exception is the `error` and the value is None, otherwise the error is None."""
+    queue = Queue(maxsize=max(size, 1))
+    stop = threading.Event()
+    trace = currentTrace()
+
+    def read():
+        failure = None
+        try:
+            with attach(trace):     # the loading is a part of the traced run
+                for item in items:
+                    try:
+                        entry = (item, load(item), None)
+                    except Exception as exc:
+                        entry = (item, None, exc)
+                    if not _put(queue, entry, stop):
+                        return
+        except Exception as exc:
+            failure = exc   # the iteration of `items` failed
+        _put(queue, (_DONE, failure), stop)
+
+    reader = threading.Thread(target=read, name="reader", daemon=True)
+    reader.start()
+    try:
+        while True:
+            entry = queue.get()
+            if entry[0] is _DONE:
+                if entry[1] is not None:
+                    raise entry[1]
+                return
+            yield entry
+    finally:
+        # the caller may stop early, the reader must not wait for it forever
+        stop.set()
+        reader.join()
+
+def writeBehind(results, write, size=STREAM_BACKLOG):
+    """Pass `results` to `write` in a background thread, while the next results are computed.
+
+    At most `size` results wait for the writer. When the writer falls behind, the computation of the results
+    is blocked until it catches up.
+
+    Parameters
+    ----------
+    results : iterable
+        The results (e.g. a generator computing them).
+    write : function
+        Called as `write(result)` for every result in their order.
+    size : int
+        The maximum number of results waiting for the writer. Defaults to `STREAM_BACKLOG`.
+
+    Raises
+    ------
+        The first exception raised by `write`. No more results are computed after it."""
+    queue = Queue(maxsize=max(size, 1))
+    errors = []
+    trace = currentTrace()
+
+    def writer():
+        with attach(trace):     # the writing is a part of the traced run
+            while True:
+                result = queue.get()
+                if result is _DONE:
+                    return
+                if errors:
+                    continue    # drain the queue after a failure
+                try:
+                    write(result)
+                except Exception as exc:
+                    errors.append(exc)
+
+    thread = threading.Thread(target=writer, name="writer", daemon=True)
+    thread.start()
+    try:
+        for result in results:
+            if errors:
+                break
+            queue.put(result)
+    finally:
+        queue.put(_DONE)
+        thread.join()
+
+    if errors:
+        raise errors[0]
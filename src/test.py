@@ -4,17 +4,56 @@ Author: Patrik Nemeth
 Xlogin: xnemet04
 School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
 """
+import os
+import json
+import time
+import tempfile
+import threading
+import tracemalloc
 import unittest
+from unittest import mock
 import numpy as np
-from scipy import misc
+from PIL import Image
+from scipy import misc, signal
 
 from normalize import normalizeMeanVariance
-from region_of_interest import getRoi
+from region_of_interest import getRoi, _slidingVariance
 from ridge_orientation import ridgeOrient
-from ridge_frequency import ridgeFreq
-from filters import gaborFilter
+from ridge_frequency import ridgeFreq, spectralOrientFreq, _findPeaks
+from filters import gaborFilter, butterworth, _gaborPixel, _gaborBank, GaborKernelBank
+from binarization import bradleyThreshold
+from thinning import zhangSuen
+from singularities import poincare, poincareIndex, singularityCleanup, clusterPoints, cancelPairs
+from fp_classes import getClass
+import points as pts
+from minutiae import extractMinutiae, calc_minutia, CROSSING_TABLE
+from lib import NEIGHBOR_OFFSETS, codeBits
+from fields import BlockField
+from pipeline import Pipeline, defaultPipeline, IMAGE
+import filters
+import batch
+import benchmark
+from parallel import ParallelExecutor, toShared, fromShared
+from streaming import readAhead, writeBehind
+from instrumentation import tracing, stage, span, formatTrace, chromeTrace
 import exceptions as ex
 
+def bradleyThresholdLoop(img, mask, windowFraction=1/12, t=15):
+    """Per-pixel reference implementation of `bradleyThreshold`."""
+    rows, cols = img.shape
+    intImg = np.cumsum(np.cumsum(img, axis=0), axis=1)
+    out = np.zeros(img.shape, dtype=bool)
+    s = int(cols * windowFraction)
+    for i in range(cols):
+        for j in range(rows):
+            x1, x2, y1, y2 = int(j - s/2), int(j + s/2), int(i - s/2), int(i + s/2)
+            if not mask[j,i] or x1 - 1 < 0 or x2 >= rows or y1 - 1 < 0 or y2 >= cols:
+                continue
+            count = (x2 - x1) * (y2 - y1)
+            sm = intImg[x2, y2] - intImg[x2, y1 - 1] - intImg[x1 - 1, y2] + intImg[x1 - 1, y1 - 1]
+            out[j,i] = (img[j,i] * count) > (sm * (100 - t) / 100)
+    return out
+
 class TestImageManipulationFunctions(unittest.TestCase):
     def setUp(self):
         # generate valid test image
@@ -33,6 +72,19 @@ class TestImageManipulationFunctions(unittest.TestCase):
         # generate list of non-bool datatypes
         self.nonBool = [1, 1.0, "1", (1,1), [1,1], np.array([1]), np.ones((1)), None]
 
+        # generate a binary image of thick blobs for thinning
+        blobs = np.random.default_rng(0).random((60, 70)) > 0.6
+        self.blobs = (blobs | np.roll(blobs, 1, axis=0) | np.roll(blobs, 1, axis=1)).astype(np.float32)
+
+        # generate a synthetic fingerprint - concentric ridges with a core in an elliptic region
+        rng = np.random.default_rng(0)
+        y, x = np.mgrid[0:200, 0:180].astype(np.float64)
+        dist = np.hypot(y - 90, x - 90)
+        ridges = 128 + 80 * np.cos(2 * np.pi * dist / 9) + rng.normal(0, 10, size=dist.shape)
+        ellipse = ((y - 90) / 85)**2 + ((x - 90) / 75)**2 < 1
+        ridges = np.where(ellipse, ridges, 200)
+        self.ridges = np.clip(ridges, 0, 255).astype(np.uint8)
+
 class TestDatatypes(TestImageManipulationFunctions):
     def testNormalization_invalid(self):
         for item in self.invalidDTypes:
@@ -158,5 +210,737 @@ class TestOptionalParams(TestImageManipulationFunctions):
             with self.assertRaises(ex.InvalidDataType):
                 gaborFilter(self.im, orientim, freq, mask, blocksize=item)
 
+class TestEquivalence(TestImageManipulationFunctions):
+    def setUp(self):
+        super().setUp()
+        norm = normalizeMeanVariance(self.ridges)
+        self.butter = butterworth(norm)
+        self.mask = getRoi(self.butter)
+        self.orientim = ridgeOrient(self.butter)
+        self.freq = ridgeFreq(self.butter, self.orientim)
+
+    def testGaborBank(self):
+        pixel = _gaborPixel(self.butter, self.orientim, self.freq, self.mask, 11)
+        bank = _gaborBank(self.butter, self.orientim, self.freq, self.mask, 11, GaborKernelBank())
+
+        # unbinarized responses within 2% of the response range
+        self.assertLess(np.abs(pixel - bank).max(), 0.02 * (pixel.max() - pixel.min()))
+
+        # binarized images differ in less than 1% of the ROI
+        differ = bradleyThreshold(pixel, self.mask) != bradleyThreshold(bank, self.mask)
+        self.assertLess(differ[self.mask].mean(), 0.01)
+
+    def testGaborKernelBank(self):
+        bank = GaborKernelBank(maxBlocksizes=2)
+        first = _gaborBank(self.butter, self.orientim, self.freq, self.mask, 11, bank)
+        generated = bank.generated
+        self.assertGreater(generated, 0)
+
+        # a repeated run reuses all the kernels and gives the same result
+        second = _gaborBank(self.butter, self.orientim, self.freq, self.mask, 11, bank)
+        self.assertEqual(bank.generated, generated)
+        self.assertTrue(np.array_equal(first, second))
+
+        # the least recently used kernel size is evicted
+        _gaborBank(self.butter, self.orientim, self.freq, self.mask, 13, bank)
+        _gaborBank(self.butter, self.orientim, self.freq, self.mask, 15, bank)
+        beforeRerun = bank.generated
+        _gaborBank(self.butter, self.orientim, self.freq, self.mask, 11, bank)
+        self.assertEqual(bank.generated - beforeRerun, generated)
+
+    def testRoiBlock(self):
+        sliding = getRoi(self.butter)
+        block = getRoi(self.butter, mode="block")
+        self.assertEqual(block.shape, sliding.shape)
+        self.assertEqual(block.dtype, bool)
+        self.assertLess((block != sliding).mean(), 0.07)    # a small image, the edge blocks are a large part of it
+        for size in [(300, 260), (500, 440), (800, 700)]:
+            butter = butterworth(normalizeMeanVariance(benchmark.syntheticFingerprint(*size)))
+            self.assertLess((getRoi(butter, mode="block") != getRoi(butter)).mean(), 0.05)
+
+        # the mask is constant within the 16x16 blocks, including the partial ones
+        blocks = block[:192, :176].reshape((12, 16, 11, 16))
+        self.assertTrue(np.all(blocks == blocks[:, :1, :, :1]))
+        self.assertTrue(np.all(block[192:] == block[192]))
+
+        self.assertFalse(getRoi(np.full((40, 50), 7.0), mode="block").any())
+        with self.assertRaises(ex.InvalidParameterValue):
+            getRoi(self.butter, mode="foo")
+
+    def testRoiIntegral(self):
+        norm = normalizeMeanVariance(self.ridges)
+        for im in [self.ridges, norm, self.butter, self.butter.astype(np.float32) + 1000]:
+            shape = (im.shape[0] - 15, im.shape[1] - 15, 16, 16)
+            patches = np.lib.stride_tricks.as_strided(im, shape=shape, strides=2 * im.strides).var(axis=(-1, -2))
+            self.assertTrue(np.allclose(_slidingVariance(im, 16), patches, rtol=1e-6, atol=1e-6 * patches.max()))
+            for threshold in [0.05, 0.1, 0.3]:
+                self.assertTrue(np.array_equal(getRoi(im, threshold), getRoi(im, threshold, method="patches")))
+
+        with self.assertRaises(ex.InvalidParameterValue):
+            getRoi(self.butter, method="foo")
+
+    def testGaborTiles(self):
+        untiled = gaborFilter(self.butter, self.orientim, self.freq, self.mask)
+        for tileSize in [16, 37, 1000]:
+            # bit-identical for tiles smaller than, not dividing and bigger than the image
+            with mock.patch.object(filters, "GABOR_TILE", tileSize):
+                tiled = _gaborBank(self.butter, self.orientim, self.freq, self.mask, 11, GaborKernelBank(), threads=3)
+            self.assertTrue(np.array_equal(tiled, _gaborBank(self.butter, self.orientim, self.freq, self.mask, 11, GaborKernelBank())))
+        self.assertTrue(np.array_equal(gaborFilter(self.butter, self.orientim, self.freq, self.mask, threads=4), untiled))
+
+    def testBradleyThreshold(self):
+        rng = np.random.default_rng(1)
+        for shape in [(50, 37), (31, 250), (5, 5)]:
+            img = rng.normal(0, 100, shape)
+            mask = rng.random(shape) > 0.3
+            self.assertTrue(np.array_equal(bradleyThreshold(img, mask), bradleyThresholdLoop(img, mask)))
+
+        img = rng.normal(0, 100, (60, 80))
+        self.assertTrue(np.array_equal(bradleyThreshold(img, mask=np.ones(img.shape), windowFraction=1/8, t=5),
+                                       bradleyThresholdLoop(img, np.ones(img.shape), windowFraction=1/8, t=5)))
+
+    def testZhangSuenLut(self):
+        pixel = zhangSuen(self.blobs, mode="pixel")
+        lut = zhangSuen(self.blobs, mode="lut")
+        self.assertEqual(lut.dtype, pixel.dtype)
+        self.assertTrue(np.array_equal(lut, pixel))
+
+        with self.assertRaises(ex.InvalidParameterValue):
+            zhangSuen(self.blobs, mode="foo")
+
+    def testZhangSuenFrontier(self):
+        stats = []
+        lut = zhangSuen(self.blobs, mode="lut")
+        frontier = zhangSuen(self.blobs, mode="frontier", stats=stats)
+        self.assertTrue(np.array_equal(frontier, lut))
+
+        # the first subiteration evaluates all the foreground pixels, the last pass deletes nothing
+        self.assertEqual(stats[0]["evaluated"], np.count_nonzero(self.blobs[1:-1,1:-1]))
+        self.assertEqual(stats[-1]["deleted"] + stats[-2]["deleted"], 0)
+        self.assertEqual(sum(s["deleted"] for s in stats), np.count_nonzero(self.blobs[1:-1,1:-1]) - np.count_nonzero(lut))
+
+    def testPoincare(self):
+        orientim = np.random.default_rng(2).random((30, 40)) * np.pi
+        cores, deltas = poincare(orientim)
+
+        expectedCores, expectedDeltas = np.zeros(orientim.shape), np.zeros(orientim.shape)
+        for i in range(1, orientim.shape[0] - 1):
+            for j in range(1, orientim.shape[1] - 1):
+                Pc = poincareIndex(orientim[i-1:i+2, j-1:j+2])
+                expectedDeltas[i,j] = -1 <= Pc <= -0.5
+                expectedCores[i,j] = 0.5 <= Pc <= 1
+
+        self.assertTrue(np.array_equal(cores, expectedCores))
+        self.assertTrue(np.array_equal(deltas, expectedDeltas))
+
+    def testPoincare_field(self):
+        # a smooth orientation field with a core and a delta
+        y, x = np.mgrid[0:200, 0:160].astype(np.float64)
+        orientim = (np.arctan2(y - 60, x - 80) / 2 - np.arctan2(y - 140, x - 80) / 2) % np.pi
+
+        cores, deltas = poincare(orientim)
+        self.assertGreater(np.sum(cores), 0)
+        self.assertGreater(np.sum(deltas), 0)
+        corePoints, deltaPoints = poincare(orientim, asPoints=True)
+        self.assertTrue(np.array_equal(np.nonzero(cores), (corePoints["y"], corePoints["x"])))
+        self.assertTrue(np.array_equal(np.nonzero(deltas), (deltaPoints["y"], deltaPoints["x"])))
+
+    def testSingularities_pipeline(self):
+        for seed in range(4):
+            pipeline = defaultPipeline()
+            pipeline.setImage(benchmark.syntheticFingerprint(300, 260, seed))
+            orientim, mask = pipeline.get("singularityOrientation"), pipeline.get("normRoi")
+            cores, deltas = poincare(orientim, asPoints=True)
+            expected = singularityCleanup(pts.inMask(cores, mask), pts.inMask(deltas, mask), mask)
+            for points, expectedPoints in zip(pipeline.get("singularities"), expected):
+                self.assertTrue(np.array_equal(points, expectedPoints))
+
+    def testCrossingTable(self):
+        for code in range(256):
+            segment = np.zeros((3,3))
+            for (dr, dc), bit in zip(NEIGHBOR_OFFSETS, codeBits(code)):
+                segment[1+dr, 1+dc] = bit
+            self.assertEqual(CROSSING_TABLE[code], calc_minutia(segment))
+
+    def testExtractMinutiae(self):
+        thinned = zhangSuen(self.blobs)
+        mask = np.ones(thinned.shape, dtype=bool)
+        bifurcations, ridgeEndings = extractMinutiae(thinned, mask)
+
+        minutiae = np.zeros(thinned.shape)
+        for i, j in zip(*np.where(thinned == 1)):
+            minutiae[i,j] = calc_minutia(thinned[i-1:i+2, j-1:j+2])
+
+        self.assertTrue(np.array_equal(bifurcations, np.where(minutiae == 6, 1, 0)))
+        self.assertTrue(np.array_equal(ridgeEndings, np.where(minutiae == 2, 1, 0)))
+
+    def testPointSets(self):
+        rng = np.random.default_rng(3)
+        cores, deltas = np.zeros((80, 90), dtype=np.float32), np.zeros((80, 90), dtype=np.float32)
+        for sings in (cores, deltas):
+            for center in rng.integers(0, 80, (4, 2)):
+                offsets = rng.integers(-6, 7, (4, 2))
+                sings[np.clip(center[0] + offsets[:,0], 0, 79), np.clip(center[1] + offsets[:,1], 0, 89)] = 1
+        mask = np.zeros(cores.shape, dtype=bool)
+        mask[5:-8, 3:-4] = True
+
+        pointCores = pts.fromDense(cores, pts.CORE)
+        pointDeltas = pts.fromDense(deltas, pts.DELTA)
+        pointCores, pointDeltas = singularityCleanup(pointCores, pointDeltas, mask)
+        denseCores, denseDeltas = singularityCleanup(cores.copy(), deltas.copy(), mask)
+
+        self.assertTrue(np.array_equal(pts.toDense(pointCores, cores.shape), denseCores))
+        self.assertTrue(np.array_equal(pts.toDense(pointDeltas, deltas.shape), denseDeltas))
+        self.assertEqual(getClass(pointCores[:1], pointDeltas[:1]), getClass(pts.toDense(pointCores[:1], cores.shape),
+                                                                             pts.toDense(pointDeltas[:1], cores.shape)))
+
+        thinned = zhangSuen(self.blobs)
+        mask = np.ones(thinned.shape, dtype=bool)
+        for dense, points in zip(extractMinutiae(thinned, mask), extractMinutiae(thinned, mask, asPoints=True)):
+            self.assertTrue(np.array_equal(pts.toDense(points, thinned.shape), dense))
+
+    def testGridIndex(self):
+        rng = np.random.default_rng(4)
+        first = pts.makePoints(rng.integers(0, 100, 200), rng.integers(0, 80, 200), pts.CORE)
+        second = pts.makePoints(rng.integers(0, 100, 150), rng.integers(0, 80, 150), pts.DELTA)
+
+        firstIdx, secondIdx = pts.GridIndex(second, 6).near(first, 5)
+        found = set(zip(firstIdx.tolist(), secondIdx.tolist()))
+
+        expected = set()
+        for i in range(first.size):
+            for j in range(second.size):
+                if (abs(int(first["y"][i]) - int(second["y"][j])) < 5 and
+                    abs(int(first["x"][i]) - int(second["x"][j])) < 5):
+                    expected.add((i, j))
+
+        self.assertEqual(found, expected)
+
+    def testGridCleanup(self):
+        cores = pts.makePoints([10, 12, 14, 50, 80], [10, 11, 16, 50, 20], pts.CORE)
+        deltas = pts.makePoints([52, 90], [47, 85], pts.DELTA)
+
+        # the chain of the first three cores is one cluster
+        clustered = clusterPoints(cores)
+        self.assertEqual(clustered.size, 3)
+        self.assertEqual((clustered["y"][0], clustered["x"][0]), (12, 12))
+
+        # the core and delta around (50, 50) cancel out
+        cores, deltas = cancelPairs(clustered, deltas)
+        self.assertEqual(cores.size, 2)
+        self.assertEqual(deltas.size, 1)
+
+        # the result does not depend on the order of the points
+        mask = np.zeros((100, 100), dtype=bool)
+        mask[5:95, 5:95] = True
+        rng = np.random.default_rng(5)
+        allCores = pts.makePoints(rng.integers(0, 100, 60), rng.integers(0, 100, 60), pts.CORE)
+        allDeltas = pts.makePoints(rng.integers(0, 100, 60), rng.integers(0, 100, 60), pts.DELTA)
+        ordered = singularityCleanup(allCores, allDeltas, mask, method="grid")
+        shuffled = singularityCleanup(rng.permutation(allCores), rng.permutation(allDeltas), mask, method="grid")
+        self.assertTrue(np.array_equal(ordered[0], shuffled[0]))
+        self.assertTrue(np.array_equal(ordered[1], shuffled[1]))
+
+        with self.assertRaises(ex.InvalidParameterValue):
+            singularityCleanup(allCores, allDeltas, mask, method="foo")
+        with self.assertRaises(ex.InvalidParameterValue):
+            extractMinutiae(mask.astype(np.float32), mask, method="foo")
+
+    def testRidgeFreqBatch(self):
+        for im, orientim in [(self.butter, self.orientim), (self.ridges, ridgeOrient(self.ridges))]:
+            for blocksize in [36, 16]:
+                rotate = ridgeFreq(im, orientim, blend_sigma=None, blocksize=blocksize, method="rotate")
+                batch = ridgeFreq(im, orientim, blend_sigma=None, blocksize=blocksize, method="batch")
+                self.assertGreater(np.count_nonzero(rotate), 0)
+                self.assertTrue(np.allclose(batch, rotate, rtol=0, atol=1e-12))
+
+        # flat tops are common in the signatures of integer images
+        signals = np.random.default_rng(6).integers(0, 4, (500, 25))
+        peaks = _findPeaks(signals)
+        for row, signature in zip(peaks, signals):
+            self.assertTrue(np.array_equal(np.flatnonzero(row), signal.find_peaks(signature)[0]))
+
+        with self.assertRaises(ex.InvalidParameterValue):
+            ridgeFreq(self.butter, self.orientim, method="foo")
+
+    def testSpectralOrientFreq(self):
+        y, x = np.mgrid[0:200, 0:180].astype(np.float64)
+        for freq, theta in [(0.1, 0.3), (0.07, 1.2), (0.15, 2.5), (0.12, np.pi/2)]:
+            im = np.cos(2 * np.pi * freq * (x * np.cos(theta) + y * np.sin(theta)))
+            orientim, freqim = spectralOrientFreq(im)
+            self.assertTrue(np.allclose(freqim, freq, rtol=0.01))
+
+            # same orientation as the gradient based estimation in the inner part of the image
+            difference = np.angle(np.exp(2j * (orientim - ridgeOrient(im)))) / 2
+            self.assertLess(np.abs(difference[40:-40, 40:-40]).max(), 0.05)
+
+        # frequencies outside of the band are rejected
+        self.assertFalse(np.any(ridgeFreq(im, orientim, blend_sigma=None, method="spectral", maxFreq=0.1)))
+
+        # close to the spatial estimation on a fingerprint
+        batch = ridgeFreq(self.butter, self.orientim, blend_sigma=None)
+        spectral = ridgeFreq(self.butter, self.orientim, blend_sigma=None, method="spectral")
+        both = (batch > 0) & (spectral > 0)
+        self.assertLess(np.median(np.abs(spectral[both] - batch[both]) / batch[both]), 0.05)
+
+    def testRidgeOrientBox(self):
+        def angleDifference(a, b):
+            return np.abs(np.angle(np.exp(2j * (a - b)))) / 2
+
+        for blendSigma in [3, 14]:
+            convolve = ridgeOrient(self.butter, blendSigma, method="convolve")
+            box = ridgeOrient(self.butter, blendSigma, method="box")
+            self.assertEqual(box.dtype, convolve.dtype)
+            self.assertLess(angleDifference(box, convolve).max(), 1e-5)
+
+            # block smoothing deviates only where the orientation changes quickly
+            block = ridgeOrient(self.butter, blendSigma, smoothing="block")
+            self.assertEqual(block.shape, convolve.shape)
+            self.assertLess(np.median(angleDifference(block, convolve)), 0.01)
+
+        with self.assertRaises(ex.InvalidParameterValue):
+            ridgeOrient(self.butter, method="foo")
+        with self.assertRaises(ex.InvalidParameterValue):
+            ridgeOrient(self.butter, smoothing="foo")
+
+    def testBlockField(self):
+        field = BlockField(np.array([[1., 2.], [3., 4.]]), 10, (25, 25), fill=0)
+        self.assertEqual(field.at(9, 10), 2)
+        self.assertEqual(field.at(24, 24), 0)
+        self.assertTrue(np.allclose(field.sample(np.array([4.5, 9.5, 0]), np.array([4.5, 9.5, 24])), [1, 2.5, 0]))
+
+        dense = field.toDense()
+        self.assertEqual(dense.shape, (25, 25))
+        self.assertTrue(np.array_equal(dense[::10, ::10], [[1, 2, 0], [3, 4, 0], [0, 0, 0]]))
+        # the pixels outside of the blocks get the fill value with interpolation too
+        self.assertTrue(np.allclose(field.toDense(interpolate=True)[[4, 9, 0], [4, 9, 24]], [1, 2.35, 0]))
+        self.assertTrue(np.allclose(BlockField(field.values, 10, (25, 25)).sample(np.array([0]), np.array([24])), [2]))
+
+        # orientations close to 0 and Pi are the same, their average is not Pi/2
+        angular = BlockField(np.array([[0.05, np.pi - 0.05]]), 10, (10, 20), angular=True)
+        self.assertAlmostEqual(np.sin(angular.sample(np.array([4.5]), np.array([9.5]))[0]), 0)
+
+    def testBlockFieldConsumers(self):
+        # the blocky frequency field gives the same image as without blending
+        freqField = ridgeFreq(self.butter, self.orientim, blend_sigma=None, asField=True)
+        self.assertTrue(np.array_equal(freqField.toDense(), ridgeFreq(self.butter, self.orientim, blend_sigma=None)))
+
+        orientField = ridgeOrient(self.butter, asField=True)
+        self.assertEqual(orientField.values.shape, (13, 12))
+
+        # the field follows the full resolution orientations except around the singularities
+        inputs = benchmark.stageInputs(benchmark.syntheticFingerprint(500, 440))
+        field, mask = ridgeOrient(inputs["butter"], asField=True), inputs["mask"]
+        difference = np.abs(np.angle(np.exp(2j * (field.toDense(interpolate=True) - inputs["orient"]))) / 2)[mask]
+        self.assertLess(np.median(difference), np.radians(0.5))
+        self.assertLess(np.mean(difference > np.radians(10)), 0.05)
+        freqField = ridgeFreq(self.butter, orientField, asField=True)
+        fromFields = gaborFilter(self.butter, orientField, freqField, self.mask)
+        fromDense = gaborFilter(self.butter, orientField.toDense(interpolate=True), freqField.toDense(interpolate=True), self.mask)
+        self.assertTrue(np.array_equal(fromFields, fromDense))
+
+        # a core and a delta from the orientations in the centers of 16x16 blocks
+        def orientation(y, x):
+            return (np.arctan2(y - 60, x - 80) / 2 - np.arctan2(y - 140, x - 80) / 2) % np.pi
+        centers = np.arange(0, 200, 16) + 7.5
+        field = BlockField(orientation(centers.reshape((-1, 1)), centers[:10].reshape((1, -1))), 16, (200, 160), angular=True)
+        cores, deltas = poincare(field, asPoints=True)
+        self.assertTrue(np.all(np.abs(cores["y"] - 60) <= 4) and np.all(np.abs(cores["x"] - 80) <= 4))
+        self.assertTrue(np.all(np.abs(deltas["y"] - 140) <= 4) and np.all(np.abs(deltas["x"] - 80) <= 4))
+        self.assertGreater(cores.size, 0)
+        self.assertGreater(deltas.size, 0)
+
+    def testGaborMode_invalid(self):
+        with self.assertRaises(ex.InvalidParameterValue):
+            gaborFilter(self.butter, self.orientim, self.freq, self.mask, mode="foo")
+
+    def testFloat32(self):
+        norm = normalizeMeanVariance(self.ridges)
+        butter = butterworth(norm, dtype=np.float32)
+        self.assertEqual(butter.dtype, np.float32)
+        self.assertLess(np.abs(butter - self.butter).max(), 1e-5 * np.ptp(self.butter))
+
+        # the orientations within the region of interest drift by less than 1e-3 radians
+        orientim = ridgeOrient(butter, dtype=np.float32)
+        self.assertEqual(orientim.dtype, np.float32)
+        difference = np.angle(np.exp(2j * (orientim - self.orientim))) / 2
+        self.assertLess(np.abs(difference[self.mask]).max(), 1e-3)
+
+        freq = ridgeFreq(butter, orientim, dtype=np.float32)
+        self.assertEqual(freq.dtype, np.float32)
+        self.assertLess(np.abs(freq - self.freq).max(), 1e-4)
+
+        # the binarized images differ in at most a few pixels
+        filtim = gaborFilter(butter, orientim, freq, self.mask, dtype=np.float32)
+        self.assertLess(np.mean(filtim != gaborFilter(self.butter, self.orientim, self.freq, self.mask)), 0.01)
+        self.assertTrue(np.array_equal(getRoi(butter), self.mask))
+
+        for function, args in [(butterworth, (norm,)), (ridgeOrient, (butter,)), (ridgeFreq, (butter, orientim)),
+                               (gaborFilter, (butter, orientim, freq, self.mask))]:
+            for dtype in [np.int32, "foo", None]:
+                with self.assertRaises(ex.InvalidParameterValue):
+                    function(*args, dtype=dtype)
+
+class TestPipeline(TestImageManipulationFunctions):
+    def setUp(self):
+        super().setUp()
+        self.pipeline = defaultPipeline()
+        self.pipeline.setImage(self.ridges)
+
+    def testResults(self):
+        norm = normalizeMeanVariance(self.ridges)
+        butter = butterworth(norm)
+        mask = getRoi(butter)
+        orientim = ridgeOrient(butter)
+        freq = ridgeFreq(butter, orientim)
+        filtim = gaborFilter(butter, orientim, freq, mask)
+        thinned = zhangSuen((np.invert(filtim) * mask).astype(np.float32))
+
+        self.assertTrue(np.array_equal(self.pipeline.get("gabor"), filtim))
+        computed = len(self.pipeline.computed)
+        self.pipeline.gaborThreads = 3
+        self.assertTrue(np.array_equal(self.pipeline.get("gabor"), filtim))
+        self.assertEqual(len(self.pipeline.computed), computed)     # the threads are not a part of the cache key
+        self.pipeline.clear()
+        self.assertTrue(np.array_equal(self.pipeline.get("gabor"), filtim))
+        self.pipeline.gaborThreads = 1
+        self.assertTrue(np.array_equal(self.pipeline.get("thinned"), thinned))
+        bifurcations, ridgeEndings = self.pipeline.get("minutiae")
+        self.assertTrue(np.array_equal(bifurcations, extractMinutiae(thinned, mask, asPoints=True)[0]))
+        self.assertIn(self.pipeline.get("fpClass"), ["arch", "whorl or twin loop", "tented arch", "left loop", "right loop", "unknown"])
+
+        # the cached results cannot be changed
+        with self.assertRaises(ValueError):
+            self.pipeline.get("thinned")[0, 0] = 1
+
+    def testRecomputation(self):
+        self.pipeline.get("minutiae")
+        self.pipeline.get("singularities")
+        computed = len(self.pipeline.computed)
+
+        # nothing is recomputed for the same image and parameters
+        self.pipeline.setImage(self.ridges.copy())
+        self.pipeline.get("minutiae")
+        self.assertEqual(len(self.pipeline.computed), computed)
+
+        # only the stages downstream of a changed parameter are recomputed
+        self.pipeline.get("minutiae", gaborSize=13)
+        self.assertEqual(self.pipeline.computed[computed:], ["gabor", "thinned", "minutiae"])
+        self.pipeline.get("singularities", gaborSize=13)
+        self.assertEqual(len(self.pipeline.computed), computed + 3)
+
+        # the datatype recomputes all the floating point stages, but not the normalization
+        self.pipeline.get("frequency", dtype="float32")
+        self.assertEqual(self.pipeline.computed[computed+3:], ["butterworth", "orientation", "frequency"])
+        self.assertEqual(self.pipeline.get("frequency", dtype="float32").dtype, np.float32)
+
+        self.pipeline.get("roi", roiMode="block")
+        self.assertEqual(self.pipeline.computed[-1], "roi")
+        self.assertTrue(np.array_equal(self.pipeline.get("roi", roiMode="block"), getRoi(self.pipeline.get("butterworth"), mode="block")))
+
+        self.pipeline.setImage(self.ridges[::-1])
+        self.pipeline.get("butterworth")
+        self.assertEqual(self.pipeline.computed[-2:], ["normalized", "butterworth"])
+
+    def testCacheSize(self):
+        pipeline = Pipeline(params={"offset" : 0}, maxEntries=2)
+        pipeline.addStage("shifted", lambda im, offset: im + offset, (IMAGE,), ("offset",))
+        pipeline.setImage(self.blobs)
+        for offset in [1, 2, 3, 1]:
+            pipeline.get("shifted", offset=offset)
+        self.assertEqual(pipeline.computed, ["shifted"] * 4)
+        pipeline.get("shifted", offset=1)
+        self.assertEqual(len(pipeline.computed), 4)
+
+    def testPipeline_invalid(self):
+        with self.assertRaises(ValueError):
+            self.pipeline.get("foo")
+        with self.assertRaises(ValueError):
+            self.pipeline.addStage("foo", lambda im : im, ("bar",))
+        with self.assertRaises(ValueError):
+            defaultPipeline().get("normalized")
+
+def _scaled(image, factor):
+    if factor == 0:
+        raise ValueError("zero")
+    return float(image.sum()), {"scaled" : image * factor}
+
+class TestInstrumentation(TestImageManipulationFunctions):
+    def setUp(self):
+        super().setUp()
+        self.butter = butterworth(normalizeMeanVariance(self.ridges))
+        self.mask = getRoi(self.butter)
+        self.orientim = ridgeOrient(self.butter)
+        self.freq = ridgeFreq(self.butter, self.orientim)
+
+    def testTracing(self):
+        filtim = gaborFilter(self.butter, self.orientim, self.freq, self.mask)
+        with tracing() as trace:
+            self.assertTrue(np.array_equal(gaborFilter(self.butter, self.orientim, self.freq, self.mask), filtim))
+            zhangSuen(self.blobs)
+
+        stages = [record for record in trace.records if record.kind == "stage"]
+        self.assertEqual([(record.name, record.depth) for record in stages],
+                         [("bradleyThreshold", 1), ("gaborFilter", 0), ("zhangSuen", 0)])
+        inner, outer, thinning = stages
+        self.assertEqual(outer.shape, self.butter.shape)
+        self.assertEqual(thinning.shape, self.blobs.shape)
+        self.assertGreaterEqual(outer.wall, inner.wall)
+        # the peak of the outer stage includes the peak of the inner one
+        self.assertGreater(inner.peak, self.butter.nbytes)
+        self.assertGreaterEqual(outer.peak, inner.peak)
+
+        summary = formatTrace(trace.toList())
+        self.assertTrue(summary.startswith("gaborFilter") or summary.startswith("zhangSuen"))
+        self.assertNotIn("bradleyThreshold", summary)
+        json.dumps(trace.toList())
+
+        # nothing is recorded outside of tracing
+        count = len(trace.records)
+        zhangSuen(self.blobs)
+        self.assertEqual(len(trace.records), count)
+
+    def testTracing_nested(self):
+        @stage
+        def failing(im):
+            raise ValueError("failed")
+
+        with tracing(memory=False) as outer:
+            with tracing(memory=False) as inner:
+                with self.assertRaises(ValueError):
+                    failing(self.blobs)
+            zhangSuen(self.blobs)
+
+        self.assertEqual([record.name for record in inner.records], ["failing"])
+        self.assertEqual([record.name for record in outer.records if record.kind == "stage"], ["zhangSuen"])
+        self.assertIsNone(outer.records[-1].peak)
+
+    def testSpans(self):
+        with mock.patch.object(filters, "GABOR_TILE", 64), tracing(memory=False) as trace:
+            zhangSuen(self.blobs, mode="frontier")
+            gaborFilter(self.butter, self.orientim, self.freq, self.mask, threads=2)
+            with span("outside", step=1):
+                pass
+
+        subiterations = [record for record in trace.records if record.name == "subiteration"]
+        self.assertGreater(len(subiterations), 2)
+        self.assertEqual(subiterations[0].args, {"iteration" : 1, "subiteration" : 1})
+        self.assertTrue(all(record.depth == 1 and record.kind == "span" for record in subiterations))
+
+        # the tiles are recorded from the threads of the pool
+        tiles = [record for record in trace.records if record.name == "tile"]
+        self.assertGreater(len(tiles), 1)
+        self.assertNotIn(trace.records[-1].thread, [record.thread for record in tiles])
+        self.assertEqual(trace.records[-1].args, {"step" : 1})
+
+        events = chromeTrace(trace.toList())["traceEvents"]
+        complete = [event for event in events if event["ph"] == "X"]
+        self.assertEqual(len(complete), len(trace.records))
+        self.assertEqual(min(event["ts"] for event in complete), 0)
+        self.assertTrue(all(event["dur"] >= 0 for event in complete))
+        names = [event for event in events if event["ph"] == "M"]
+        self.assertEqual(len(names), len(set(record.thread for record in trace.records)))
+        json.dumps(events)
+
+    def testSpans_memory(self):
+        # only the thread, which started the trace, resets the peak of tracemalloc, which is shared by all threads
+        resetPeak, threads = tracemalloc.reset_peak, set()
+        def recordThread():
+            threads.add(threading.get_ident())
+            resetPeak()
+
+        with mock.patch.object(filters, "GABOR_TILE", 64), mock.patch.object(tracemalloc, "reset_peak", recordThread), \
+             tracing() as trace:
+            gaborFilter(self.butter, self.orientim, self.freq, self.mask, threads=2)
+
+        self.assertEqual(threads, {threading.get_ident()})
+        tiles = [record for record in trace.records if record.name == "tile"]
+        self.assertGreater(len(tiles), 1)
+        self.assertTrue(all(record.peak is None for record in tiles))
+        self.assertGreater(trace.records[-1].peak, self.butter.nbytes)
+
+class TestParallel(unittest.TestCase):
+
+    def testSharedArray(self):
+        array = np.arange(12, dtype=np.float32).reshape((3, 4))
+        shared, shm = toShared(array)
+        shm.close()
+        self.assertTrue(np.array_equal(fromShared(shared, unlink=True), array))
+        self.assertEqual(fromShared(toShared(np.zeros((0, 3)))[0], unlink=True).shape, (0, 3))
+
+    def testMap(self):
+        images = [np.full((4, 5), i, dtype=np.uint8) for i in range(6)]
+        executor = ParallelExecutor(2, prefetch=1)
+        results = list(executor.map(_scaled, images, args=(2,)))
+
+        self.assertEqual([result.value for result in results], [20.0 * i for i in range(6)])
+        for image, result in zip(images, results):
+            self.assertIsNone(result.error)
+            self.assertTrue(np.array_equal(result.arrays["scaled"], image * 2))
+        self.assertEqual(sum(count for count, _ in executor.workers.values()), 6)
+        self.assertGreater(executor.throughput()[None], 0)
+
+    def testMap_errors(self):
+        def load(item):
+            if item is None:
+                raise IOError("cannot load")
+            return item
+        results = list(ParallelExecutor(2).map(_scaled, [np.ones((2, 2)), None, np.ones((2, 2))], load, (0,)))
+        self.assertEqual([type(result.error) for result in results], [ValueError, OSError, ValueError])
+
+class TestStreaming(unittest.TestCase):
+    def testReadAhead(self):
+        loaded = []
+        def load(item):
+            if item == 3:
+                raise ValueError("cannot load")
+            loaded.append(item)
+            return item * 10
+
+        stream = readAhead(range(100), load, size=2)
+        first = [next(stream) for _ in range(5)]
+        self.assertEqual([entry[:2] for entry in first], [(0, 0), (1, 10), (2, 20), (3, None), (4, 40)])
+        self.assertIsInstance(first[3][2], ValueError)
+
+        # the reader waits for the consumer - at most the queue and one item in hand are ahead
+        time.sleep(0.3)
+        self.assertLessEqual(len(loaded), 4 + 2 + 1)
+
+        stream.close()
+        self.assertEqual([entry[1] for entry in readAhead(range(3), load)], [0, 10, 20])
+
+    def testWriteBehind(self):
+        written = []
+        writeBehind(iter(range(50)), written.append, size=3)
+        self.assertEqual(written, list(range(50)))
+
+        computed = []
+        def results():
+            for i in range(50):
+                computed.append(i)
+                yield i
+        def write(result):
+            if result == 5:
+                raise IOError("cannot write")
+        with self.assertRaises(OSError):
+            writeBehind(results(), write, size=3)
+        self.assertLess(len(computed), 50)
+
+class TestBenchmark(unittest.TestCase):
+    def testRunBenchmarks(self):
+        results = benchmark.runBenchmarks([(120, 100)], repeat=1)
+        self.assertEqual([result["stage"] for result in results["results"]], list(benchmark.STAGES))
+        for result in results["results"]:
+            self.assertEqual(result["size"], "120x100")
+            self.assertEqual(len(result["times"]), 1)
+            self.assertGreater(result["peak"], 0)
+        json.dumps(results)
+
+        results32 = benchmark.runBenchmarks([(120, 100)], ["gaborFilter"], repeat=1, dtype="float32")
+        self.assertEqual(results32["meta"]["dtype"], "float32")
+
+        previous = json.loads(json.dumps(results))
+        previous["results"][0]["time"] = results["results"][0]["time"] / 2
+        previous["results"][1]["peak"] = 0
+        rows = benchmark.compare(results, previous)
+        self.assertEqual(len(rows), len(benchmark.STAGES))
+        self.assertTrue(rows[0][4])
+        self.assertIsNone(rows[1][3])
+        self.assertFalse(any(row[4] for row in rows[2:]))
+
+class TestBatch(TestImageManipulationFunctions):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.directory.name, "in")
+        self.output = os.path.join(self.directory.name, "out")
+        os.mkdir(self.input)
+        Image.fromarray(self.ridges).save(os.path.join(self.input, "a.png"))
+        Image.fromarray(self.ridges[::-1].copy()).save(os.path.join(self.input, "b.bmp"))
+        with open(os.path.join(self.input, "notes.txt"), "w") as f:
+            f.write("not an image")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testFindImages(self):
+        files = batch.findImages([self.input, os.path.join(self.input, "notes.txt")])
+        self.assertEqual([os.path.basename(f) for f in files], ["a.png", "b.bmp", "notes.txt"])
+
+    def testMain(self):
+        status = batch.main([self.input, "-o", self.output, "-s", "roi,minutiae,class", "--images", "--trace"])
+        self.assertEqual(status, 0)
+
+        with open(os.path.join(self.output, "a.png.json")) as f:
+            record = json.load(f)
+        self.assertEqual(list(record["stages"]), ["roi", "minutiae", "class"])
+        self.assertEqual(record["stages"]["class"], self.pipelineResult("fpClass"))
+        self.assertEqual(len(record["stages"]["minutiae"]["ridgeEndings"]), self.pipelineResult("minutiae")[1].size)
+        # the angles can be read from an orientation field as well
+        field = BlockField(np.full((3, 3), 0.8), 16, (40, 40), angular=True)     # 45.8 degrees
+        points = pts.makePoints([5, 30], [7, 12], pts.RIDGE_ENDING)
+        self.assertEqual([record["angle"] for record in batch.pointRecords(points, field)], [45, 45])
+
+        # the angles of the minutiae are read from the full resolution orientation image
+        orientim, ridgeEndings = self.pipelineResult("orientation"), self.pipelineResult("minutiae")[1]
+        angles = (orientim[ridgeEndings["y"], ridgeEndings["x"]] * 180/np.pi).astype(int) % 180
+        self.assertEqual([item["angle"] for item in record["stages"]["minutiae"]["ridgeEndings"]], list(angles))
+        self.assertTrue(os.path.isfile(record["stages"]["roi"]["image"]))
+        self.assertIn("extractMinutiae", [stage["name"] for stage in record["trace"]])
+
+        # a broken file is reported and the others are processed
+        tracePath = os.path.join(self.directory.name, "trace.json")
+        status = batch.main([self.input, os.path.join(self.input, "notes.txt"), "-o", self.output, "-s", "class",
+                             "--chrome-trace", tracePath])
+        self.assertEqual(status, 1)
+
+        with open(tracePath) as f:
+            names = set(event["name"] for event in json.load(f)["traceEvents"])
+        self.assertTrue({"loadImage", "getRoi", "getClass", "writeResult", "thread_name"} <= names)
+
+        # the results of files with the same name and different extensions are kept apart, files with the same name
+        #   in different directories are refused
+        Image.fromarray(self.ridges).save(os.path.join(self.input, "b.png"))
+        self.assertEqual(batch.main([self.input, "-o", self.output, "-s", "roi"]), 0)
+        self.assertTrue(os.path.isfile(os.path.join(self.output, "b.png.json")))
+        self.assertTrue(os.path.isfile(os.path.join(self.output, "b.bmp.json")))
+        other = os.path.join(self.directory.name, "other")
+        os.mkdir(other)
+        Image.fromarray(self.ridges).save(os.path.join(other, "a.png"))
+        self.assertEqual(batch.main([self.input, other, "-o", self.output, "-s", "roi"]), 1)
+
+    def testJobs(self):
+        files = batch.findImages([self.input])
+        serial = [record for record, _ in batch.runBatch(files, ["singularities", "minutiae"])]
+        executor = ParallelExecutor(2)
+        results = list(batch.runBatch(files + ["missing.png"], ["singularities", "minutiae", "thinning"], executor=executor))
+        for a, (b, arrays) in zip(serial, results):
+            self.assertEqual(a["file"], b["file"])
+            self.assertEqual(a["shape"], b["shape"])
+            self.assertEqual(a["stages"]["singularities"], b["stages"]["singularities"])
+            self.assertEqual(a["stages"]["minutiae"], b["stages"]["minutiae"])
+            self.assertEqual(arrays["thinning"].shape, tuple(b["shape"]))
+        self.assertIn("error", results[-1][0])
+        self.assertEqual(sum(count for count, _ in executor.workers.values()), len(files))
+
+    def testArgs_invalid(self):
+        with self.assertRaises(SystemExit):
+            batch.parseArgs([self.input, "-s", "foo"])
+        with self.assertRaises(SystemExit):
+            batch.parseArgs([self.input, "--images"])
+        with self.assertRaises(SystemExit):
+            batch.parseArgs([self.input, "--dtype", "float16"])
+        with self.assertRaises(SystemExit):
+            batch.parseArgs([self.input, "--roi-mode", "foo"])
+        self.assertEqual(batch.parseArgs([self.input, "--roi-mode", "block"]).params["roiMode"], "block")
+        with self.assertRaises(SystemExit):
+            batch.parseArgs([self.input, "--gabor-threads", "0"])
+        self.assertEqual(batch.parseArgs([self.input, "--gabor-threads", "4"]).gabor_threads, 4)
+
+    def pipelineResult(self, stage):
+        pipeline = defaultPipeline()
+        pipeline.setImage(self.ridges)
+        return pipeline.get(stage)
+
 if __name__ == '__main__':
     unittest.main()
@@ -11,13 +11,50 @@ from ridge_orientation import ridgeOrient
 from filters import butterworth
 from singularities import poincare, singularityCleanup
 from fp_classes import getClass
+from points import inMask
+from parallel import ParallelExecutor
 
 import os
 import argparse
 from glob import glob
 from PIL import Image
 
-def checkClasses(file_path, expect):
+def loadImage(f):
+    img = Image.open(f)
+    img = img.convert("L")
+    return np.asarray(img)
+
+def classify(img):
+    norm = normalizeMeanVariance(img)
+    butter = butterworth(norm)
+    mask = getRoi(butter)
+    orient = ridgeOrient(butter * mask, blendSigma=14)
+    cores, deltas = poincare(orient, asPoints=True)
+    cores, deltas = inMask(cores, mask), inMask(deltas, mask)
+    cores, deltas = singularityCleanup(cores, deltas, mask)
+
+    return (getClass(cores, deltas), cores.size, deltas.size), {}
+
+def classifyFiles(files, jobs=1):
+    """Yield the (class, core count, delta count) of the files in their order. With more than 1 job the files
+    are classified in a pool of processes."""
+    if jobs <= 1:
+        for f in files:
+            yield classify(loadImage(f))[0]
+        return
+
+    executor = ParallelExecutor(jobs)
+    for result in executor.map(classify, files, loadImage):
+        if result.error is not None:
+            raise result.error
+        yield result.value
+
+    for worker, rate in executor.throughput().items():
+        if worker is not None:
+            print("Worker " + str(worker) + ": " + "{:.2f}".format(rate) + " files/s")
+    print("Total: " + "{:.2f}".format(executor.throughput()[None]) + " files/s")
+
+def checkClasses(file_path, expect, jobs=1):
     files = {}
 
     if file_path[-1] == '/':
@@ -37,22 +74,9 @@ def checkClasses(file_path, expect):
     with open(file_path + "/out.txt", mode="w") as out:
         out.write("FILE : CLASS" + "\r\n")
         print("FILE : CLASS ; core count | delta count")
-        for f in files:
-            img = Image.open(f)
-            img = img.convert("L")
-            img = np.asarray(img)
-
-            norm = normalizeMeanVariance(img)
-            butter = butterworth(norm)
-            mask = getRoi(butter)
-            orient = ridgeOrient(butter * mask, blendSigma=14)
-            cores, deltas = poincare(orient) * mask
-            cores, deltas = singularityCleanup(cores, deltas, mask)
-
-            fpClass = getClass(cores, deltas)
-
+        for (fpClass, coreCount, deltaCount), f in zip(classifyFiles(files, jobs), files):
             out.write(f + " : " + fpClass + "\r\n")
-            print(f + " : " + fpClass, " ; ", np.sum(cores), " | ", np.sum(deltas))
+            print(f + " : " + fpClass, " ; ", coreCount, " | ", deltaCount)
             if expect == fpClass:
                 countCorrect += 1
 
@@ -78,9 +102,12 @@ def main():
                                 'Specifies what class the evaluator should expect in DIR. The ones with multiple words'
                                 'need to be in quotes.')
 
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        help='Number of worker processes classifying the fingerprints. Defaults to 1.')
+
     args = parser.parse_args()
     
-    checkClasses(args.directory, args.expected)
+    checkClasses(args.directory, args.expected, args.jobs)
 
 if __name__ == "__main__":
     main()
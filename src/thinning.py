@@ -6,6 +6,10 @@ School: Vysoke Uceni Technicke v Brne, Fakulta Informacnich Technologii
 """
 import numpy as np
 
+import exceptions as e
+from lib import neighborCodes, codeBits, NEIGHBOR_OFFSETS
+from instrumentation import stage, span
+
 def neighborCount(window):
     """Find the number of neighboring 1 pixels around the center pixel in a 3x3 window `window`.
     
@@ -48,7 +52,39 @@ def zeroToOnePatternCount(unrolled_window):
     #   summing these values gives us the number of 0->1 patterns
     return diffs[diffs == 1].sum()
 
-def zhangSuen(im):
+def deletionTable(subiteration):
+    """Precompute the Zhang-Suen deletion conditions for all the 256 possible neighborhoods of a pixel.
+
+    Parameters
+    ----------
+    subiteration : int
+        Either 1 or 2 - the Zhang-Suen subiteration, for which the conditions apply.
+
+    Returns
+    -------
+        A boolean array of 256 values indexed by the neighborhood codes from `lib.neighborCodes()`.
+        True means that a foreground pixel with such a neighborhood is deleted."""
+    P2, P3, P4, P5, P6, P7, P8, P9 = 0,1,2,3,4,5,6,7
+
+    table = np.zeros(256, dtype=bool)
+    for code in range(256):
+        unrolled = codeBits(code)
+
+        if subiteration == 1:
+            cond = unrolled[P2] * unrolled[P4] * unrolled[P6] == 0 and unrolled[P4] * unrolled[P6] * unrolled[P8] == 0
+        else:
+            cond = unrolled[P2] * unrolled[P4] * unrolled[P8] == 0 and unrolled[P2] * unrolled[P6] * unrolled[P8] == 0
+
+        table[code] = 2 <= np.sum(unrolled) <= 6 and zeroToOnePatternCount(unrolled) == 1 and cond
+
+    return table
+
+# deletion tables for both of the Zhang-Suen subiterations
+DELETE_FIRST = deletionTable(1)
+DELETE_SECOND = deletionTable(2)
+
+@stage
+def zhangSuen(im, mode="lut", stats=None):
     """Binary image thinning based on the Zhang-Suen method.
     Based on:
     Zhang, T. Y. a Suen, C. Y. A Fast Parallel Algorithm for Thinning Digital
@@ -59,10 +95,27 @@ def zhangSuen(im):
     ----------
     im : numpy_array
         The input binary image to be thinned.
+    mode : str
+        Either "lut", "frontier" or "pixel". The "pixel" mode checks the deletion conditions pixel by pixel.
+        The "lut" mode encodes the neighborhood of every pixel into an 8 bit code and looks the conditions up
+        in the precomputed `DELETE_FIRST` and `DELETE_SECOND` tables for the whole image at once. The "frontier"
+        mode uses the same tables, but only evaluates the pixels next to the ones deleted since the last
+        evaluation with the same table. All the modes give the same result for binary images. Defaults to "lut".
+    stats : list
+        If a list is given in the "frontier" mode, a dictionary with the keys "iteration", "subiteration",
+        "evaluated" and "deleted" is appended to it after every subiteration, containing the number of
+        evaluated and deleted pixels. Defaults to None.
         
     Returns
     -------
         Thinned image of the same size as `im`."""
+    if mode == "lut":
+        return _zhangSuenLut(im)
+    elif mode == "frontier":
+        return _zhangSuenFrontier(im, stats)
+    elif mode != "pixel":
+        raise e.InvalidParameterValue("The specified thinning mode is not recognised.")
+
     # indices for the unrolled window corresponding to the pixels specified in the Zhang-Suen paper
     P2, P3, P4, P5, P6, P7, P8, P9 = 0,1,2,3,4,5,6,7
 
@@ -74,35 +127,123 @@ def zhangSuen(im):
     im_cp = np.copy(im)
 
     still_going1, still_going2 = True, True
+    iteration = 0
     while still_going1 or still_going2:
+        iteration += 1
         still_going1, still_going2 = False, False
         
-        i,j = np.where(im)
-        for i, j in zip(i, j):
-            window = im[i-1:i+2, j-1:j+2]   # take a 3x3 window around the current pixel
-            unrolled = window[[0,0,1,2,2,2,1,0], [1,2,2,2,1,0,0,0]]    # select the "circle" around the center pixel
-
-            if  (2 <= neighborCount(window) <= 6 and
-                zeroToOnePatternCount(unrolled) == 1 and
-                unrolled[P2] * unrolled[P4] * unrolled[P6] == 0 and
-                unrolled[P4] * unrolled[P6] * unrolled[P8] == 0):
-                im_cp[i,j] = 0
-                still_going1 = True
-        
+        with span("subiteration", iteration=iteration, subiteration=1):
+            i,j = np.where(im)
+            for i, j in zip(i, j):
+                window = im[i-1:i+2, j-1:j+2]   # take a 3x3 window around the current pixel
+                unrolled = window[[0,0,1,2,2,2,1,0], [1,2,2,2,1,0,0,0]]    # select the "circle" around the center pixel
+
+                if  (2 <= neighborCount(window) <= 6 and
+                    zeroToOnePatternCount(unrolled) == 1 and
+                    unrolled[P2] * unrolled[P4] * unrolled[P6] == 0 and
+                    unrolled[P4] * unrolled[P6] * unrolled[P8] == 0):
+                    im_cp[i,j] = 0
+                    still_going1 = True
+
         im = np.copy(im_cp)
-        i,j = np.where(im)
-        for i, j in zip(i, j):
-            # same as the first subiteration, with the deletion conditions changed as per Zhang-Suen
-            window = im[i-1:i+2, j-1:j+2]
-            unrolled = window[[0,0,1,2,2,2,1,0], [1,2,2,2,1,0,0,0]]
-
-            if  (2 <= neighborCount(window) <= 6 and
-                zeroToOnePatternCount(unrolled) == 1 and
-                unrolled[P2] * unrolled[P4] * unrolled[P8] == 0 and
-                unrolled[P2] * unrolled[P6] * unrolled[P8] == 0):
-                im_cp[i,j] = 0
-                still_going2 = True
+        with span("subiteration", iteration=iteration, subiteration=2):
+            i,j = np.where(im)
+            for i, j in zip(i, j):
+                # same as the first subiteration, with the deletion conditions changed as per Zhang-Suen
+                window = im[i-1:i+2, j-1:j+2]
+                unrolled = window[[0,0,1,2,2,2,1,0], [1,2,2,2,1,0,0,0]]
+
+                if  (2 <= neighborCount(window) <= 6 and
+                    zeroToOnePatternCount(unrolled) == 1 and
+                    unrolled[P2] * unrolled[P4] * unrolled[P8] == 0 and
+                    unrolled[P2] * unrolled[P6] * unrolled[P8] == 0):
+                    im_cp[i,j] = 0
+                    still_going2 = True
 
         im = np.copy(im_cp)
 
     return im
+
+def _zhangSuenLut(im):
+    """Zhang-Suen thinning of the whole image at once via the deletion lookup tables.
+    See `zhangSuen()` for the description of the parameters.
+
+    Returns
+    -------
+        Thinned image of the same size as `im`."""
+    foo = np.zeros_like(im)
+    foo[1:-1,1:-1] = 1
+
+    im = foo * im
+    fg = im != 0
+
+    iteration = 0
+    still_going1, still_going2 = True, True
+    while still_going1 or still_going2:
+        iteration += 1
+        # both subiterations decide on all the pixels based on the image from before the subiteration
+        with span("subiteration", iteration=iteration, subiteration=1):
+            delete = fg & DELETE_FIRST[neighborCodes(fg)]
+            fg &= ~delete
+            still_going1 = delete.any()
+
+        with span("subiteration", iteration=iteration, subiteration=2):
+            delete = fg & DELETE_SECOND[neighborCodes(fg)]
+            fg &= ~delete
+            still_going2 = delete.any()
+
+    return im * fg
+
+def _zhangSuenFrontier(im, stats=None):
+    """Zhang-Suen thinning via the deletion lookup tables, which only revisits pixels around previous deletions.
+    A pixel, whose neighborhood did not change since it was last evaluated with a table, would not be deleted
+    by that table now either, so it does not need to be evaluated again.
+    See `zhangSuen()` for the description of the parameters.
+
+    Returns
+    -------
+        Thinned image of the same size as `im`."""
+    foo = np.zeros_like(im)
+    foo[1:-1,1:-1] = 1
+
+    im = foo * im
+    fg = im != 0
+    fgFlat = fg.reshape(-1)     # a view - flat indices are used for the candidate pixels
+
+    cols = im.shape[1]
+    offsets = np.array([dr * cols + dc for dr, dc in NEIGHBOR_OFFSETS])
+    bits = np.arange(8, dtype=np.uint8)
+
+    # masks of pixels to be evaluated in the next first and second subiteration - at first all the foreground pixels
+    pending = [fgFlat.copy(), fgFlat.copy()]
+    tables = [DELETE_FIRST, DELETE_SECOND]
+
+    iteration = 0
+    still_going1, still_going2 = True, True
+    while still_going1 or still_going2:
+        iteration += 1
+        deletedCounts = []
+        for sub in (0, 1):
+            with span("subiteration", iteration=iteration, subiteration=sub + 1):
+                candidates = np.flatnonzero(pending[sub] & fgFlat)
+
+                # the border is zeroed, so all the neighbors of a foreground pixel are inside the image
+                neighbors = fgFlat[candidates[:, np.newaxis] + offsets].astype(np.uint8)
+                codes = np.bitwise_or.reduce(neighbors << bits, axis=1)
+                deleted = candidates[tables[sub][codes]]
+                fgFlat[deleted] = False
+
+                # the neighbors of the deleted pixels need to be evaluated again with both of the tables
+                changed = deleted[:, np.newaxis] + offsets
+                pending[sub][:] = False
+                pending[sub][changed] = True
+                pending[1 - sub][changed] = True
+
+                deletedCounts.append(deleted.size)
+                if stats is not None:
+                    stats.append({"iteration" : iteration, "subiteration" : sub + 1,
+                                  "evaluated" : int(candidates.size), "deleted" : int(deleted.size)})
+
+        still_going1, still_going2 = deletedCounts[0] != 0, deletedCounts[1] != 0
+
+    return im * fg